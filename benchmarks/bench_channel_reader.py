@@ -0,0 +1,69 @@
+"""
+Compares the old PTY/sudo output reader of execute_command_raw
+(1 KiB recv() calls with str concatenation) against
+shell_util.channel_reader.read_channel on a fake channel.
+
+The old reader grows quadratically (~8-17s for 5 MB, ~76s for 10 MB), so it
+is measured on at most OLD_READER_MAX_MB of the payload.
+
+Usage:
+    python3 -m benchmarks.bench_channel_reader [size_in_MB]
+"""
+import sys
+import time
+
+from shell_util.channel_reader import decode_lines, read_channel
+
+OLD_READER_MAX_MB = 5
+
+
+class FakeChannel(object):
+    """Serves a pre-built payload like paramiko.Channel.recv() would"""
+    def __init__(self, payload):
+        self.payload = memoryview(payload)
+        self.offset = 0
+        self.in_window_size = 2097152
+
+    def recv(self, nbytes):
+        chunk = self.payload[self.offset:self.offset + nbytes]
+        self.offset += len(chunk)
+        return bytes(chunk)
+
+
+def old_reader(channel):
+    temp = ''
+    data = channel.recv(1024)
+    while data:
+        temp += data.decode()
+        data = channel.recv(1024)
+    return temp.splitlines()
+
+
+def new_reader(channel):
+    return decode_lines(read_channel(channel))
+
+
+def run(size_mb):
+    for text in ("2024-01-01T00:00:00 ns_server:info,couchbase log line\n",
+                 "2024-01-01T00:00:00 ns_server:info,couchbase \u20ac line\n"):
+        line = text.encode()
+        payload = line * (size_mb * 1024 * 1024 // len(line))
+        print("{} MB payload, line: {!r}".format(size_mb, text))
+        for name, reader in (("old (recv(1024) + str +=)", old_reader),
+                             ("new (read_channel)", new_reader)):
+            data = payload
+            if reader is old_reader and size_mb > OLD_READER_MAX_MB:
+                data = payload[:OLD_READER_MAX_MB * 1024 * 1024]
+            start = time.time()
+            try:
+                result = "{} lines".format(len(reader(FakeChannel(data))))
+            except UnicodeDecodeError as e:
+                result = "failed: {}".format(e)
+            elapsed = time.time() - start
+            print("  {:<28} {:4} MB {:8.2f}s {:8.1f} MB/s  {}"
+                  .format(name, len(data) // 1048576, elapsed,
+                          len(data) / 1048576 / elapsed, result))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -1,6 +1,8 @@
 import json
 import re
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import urlopen
 
 from install_util.constants.build import SUPPORTED_OS, BuildUrl
@@ -11,18 +13,47 @@ class InstallHelper(object):
     def __init__(self, logger):
         self.log = logger
 
-    def check_server_state(self, servers):
+    def __probe_server(self, server):
+        """
+        Connects to the server, which also populates the
+        RemoteMachineShellConnection's RemoteMachineInfo cache
+        :return: Tuple of (is_reachable, discovery time in secs)
+        """
+        start_time = time.time()
+        try:
+            shell = RemoteMachineShellConnection(server)
+            shell.disconnect()
+            return True, time.time() - start_time
+        except Exception as e:
+            self.log.error("{} - {}".format(server.ip, e))
+            return False, time.time() - start_time
+
+    def check_server_state(self, servers, max_workers=10):
+        """
+        Checks the reachability of all servers concurrently
+        :param servers: List of servers to check
+        :param max_workers: Max. number of servers probed in parallel
+        :return: True if all servers are reachable, else False
+        """
         result = True
         reachable = list()
         unreachable = list()
-        for server in servers:
-            try:
-                shell = RemoteMachineShellConnection(server)
-                shell.disconnect()
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            probe_results = list(executor.map(self.__probe_server, servers))
+        for server, (is_reachable, elapsed) in zip(servers, probe_results):
+            if is_reachable:
                 reachable.append(server.ip)
-            except Exception as e:
-                self.log.error(e)
+                self.log.info("{} - Reachable, discovery took {:.2f}s"
+                              .format(server.ip, elapsed))
+            else:
                 unreachable.append(server.ip)
+                self.log.error("{} - Unreachable, gave up after {:.2f}s"
+                               .format(server.ip, elapsed))
+        self.log.info("Checked {} servers in {:.2f}s. Reachable: {}, "
+                      "Unreachable: {}"
+                      .format(len(servers), time.time() - start_time,
+                              len(reachable), len(unreachable)))
 
         if len(unreachable) > 0:
             self.log.info("-" * 100)
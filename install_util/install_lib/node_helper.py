@@ -192,7 +192,8 @@ class InstallSteps(object):
     def copy_build_to_server(self, node_installer, build_url):
         f_path = "{}/{}".format(".", build_url.split('/')[-1])
         result = node_installer.shell.copy_file_local_to_remote(
-            f_path, node_installer.shell.download_dir)
+            f_path, node_installer.shell.download_dir, resume=True,
+            skip_if_same=True)
         return result
 
     def download_build(self, node_installer, build_url,
@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import logging
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE
+
+from shell_util.shell_conn import ShellConnection
+
+log = logging.getLogger("shell_util")
+
+
+class AsyncShellConnection(object):
+    """
+    asyncio counterpart of ShellConnection.
+
+    Blocking paramiko operations (handshake, channel setup, SFTP requests)
+    are delegated to one process wide, bounded executor, while waiting for
+    command output is done on the event loop itself by polling the channel's
+    file descriptor. A long running command therefore does not hold a thread
+    and thousands of node operations can be in flight on a single loop.
+
+    Commands take one of the session slots of the underlying
+    ShellConnection, so async and sync callers sharing it stay within the
+    server's MaxSessions together. A command whose await gets cancelled or
+    times out is abandoned: its channel is closed, or the local process
+    killed.
+
+    Return values match the ones of the synchronous API.
+    """
+    # Max. threads used for the blocking parts, shared by all connections
+    max_workers = 32
+    __executor = None
+
+    def __init__(self, test_server):
+        self.server = test_server
+        self.ip = test_server.ip
+        self.shell = ShellConnection(test_server)
+        self.info = None
+        self.log = log
+
+    @classmethod
+    def get_executor(cls):
+        if cls.__executor is None:
+            cls.__executor = ThreadPoolExecutor(
+                max_workers=cls.max_workers,
+                thread_name_prefix="async_shell")
+        return cls.__executor
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.get_executor(), functools.partial(func, *args, **kwargs))
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.disconnect()
+
+    async def connect(self):
+        await self._run_blocking(
+            self.shell.ssh_connect_with_retries, self.server.ip,
+            self.server.ssh_username, self.server.ssh_password,
+            self.server.ssh_key)
+
+    async def disconnect(self):
+        await self._run_blocking(self.shell.disconnect)
+
+    async def extract_remote_info(self):
+        self.info = await self._run_blocking(self.shell.extract_remote_info)
+        return self.info
+
+    async def file_exists(self, remotepath, filename, pause_time=30):
+        return await self._run_blocking(self.shell.file_exists, remotepath,
+                                        filename, pause_time=pause_time)
+
+    async def copy_file_local_to_remote(self, src_path, des_path):
+        return await self._run_blocking(
+            self.shell.copy_file_local_to_remote, src_path, des_path)
+
+    async def execute_command(self, command, info=None, debug=True,
+                              timeout=600, get_exit_code=False):
+        if self.shell.info is None and info is not None:
+            self.shell.info = info
+        if self.shell.info is not None \
+                and self.shell.info.type.lower() == 'windows':
+            self.shell.use_sudo = False
+        if getattr(self.shell, "use_sudo", False):
+            command = "sudo " + command
+        return await self.execute_command_raw(
+            command, debug=debug, timeout=timeout, get_exit_code=get_exit_code)
+
+    async def execute_command_raw(self, command, debug=True, timeout=600,
+                                  get_exit_code=False):
+        self.log.debug("%s - Running command.raw: %s" % (self.ip, command))
+        if self.shell.remote:
+            out, err, exit_code = await self.__run_on_channel(command,
+                                                              timeout)
+        else:
+            p = await asyncio.create_subprocess_shell(command, stdout=PIPE,
+                                                      stderr=PIPE)
+            try:
+                out, err = await asyncio.wait_for(p.communicate(), timeout)
+            except BaseException:
+                # Timed out or cancelled, don't leave the command running
+                if p.returncode is None:
+                    p.kill()
+                    await p.wait()
+                raise
+            exit_code = p.returncode
+
+        output = [line.decode('utf-8', errors='replace')
+                  for line in out.splitlines()]
+        error = [line.decode('utf-8', errors='replace')
+                 for line in err.splitlines()]
+        if debug and error:
+            self.log.info('command executed with {} but got an error {} ...'
+                          .format(self.server.ssh_username, str(error)[:400]))
+        return (output, error, exit_code) if get_exit_code else (output, error)
+
+    async def __acquire_slot(self, slots):
+        # Polled, a blocking acquire() in the executor would still take
+        # the slot after the await got cancelled
+        delay = 0.005
+        while not slots.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    @staticmethod
+    def __discard_channel(slots, future):
+        if not future.cancelled() and future.exception() is None:
+            future.result().close()
+        slots.release()
+
+    async def __run_on_channel(self, command, timeout):
+        slots = self.shell._session_slots
+        await self.__acquire_slot(slots)
+        future = self.get_executor().submit(self.__open_channel, command)
+        try:
+            channel = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The executor thread still opens the channel, close it then
+            future.add_done_callback(
+                functools.partial(self.__discard_channel, slots))
+            raise
+        except BaseException:
+            slots.release()
+            raise
+        try:
+            return await self.__drain_channel(channel, timeout)
+        finally:
+            channel.close()
+            slots.release()
+
+    def __open_channel(self, command):
+        self.shell.reconnect_if_inactive()
+        channel = self.shell._ssh_client.get_transport().open_session()
+        channel.exec_command(command)
+        return channel
+
+    async def __drain_channel(self, channel, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        readable = asyncio.Event()
+        fd = channel.fileno()
+        loop.add_reader(fd, readable.set)
+        stdout, stderr = list(), list()
+        try:
+            while True:
+                readable.clear()
+                while channel.recv_ready():
+                    stdout.append(channel.recv(32768))
+                while channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(32768))
+                if channel.eof_received and not channel.recv_ready() \
+                        and not channel.recv_stderr_ready():
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise socket.timeout("Command timed out on {}"
+                                         .format(self.ip))
+                try:
+                    await asyncio.wait_for(readable.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader(fd)
+        if channel.exit_status_ready():
+            exit_code = channel.recv_exit_status()
+        else:
+            exit_code = await self._run_blocking(channel.recv_exit_status)
+        return b"".join(stdout), b"".join(stderr), exit_code
@@ -0,0 +1,223 @@
+import os
+import select
+import socket
+from collections import deque
+
+# Bytes requested per read from a channel / pipe
+READ_SIZE = 32768
+
+
+def read_channel(channel):
+    """
+    Read a channel's stdout until EOF.
+    Reads are sized after the channel's receive window and collected in a
+    bytearray, so the cost stays linear in the size of the output.
+    :param channel: paramiko.Channel object with an executed command
+    :return: bytearray with the complete output
+    """
+    read_size = max(READ_SIZE, getattr(channel, "in_window_size", 0))
+    data = bytearray()
+    chunk = channel.recv(read_size)
+    while chunk:
+        data += chunk
+        chunk = channel.recv(read_size)
+    return data
+
+
+def iter_channel(channel, timeout=600):
+    """
+    Yields (is_stderr, data) chunks from both streams of the channel as
+    soon as either one has data. Draining stdout and stderr together keeps
+    the SSH window open, so the remote side never blocks on a full stream.
+    :param channel: paramiko.Channel object with an executed command
+    :param timeout: Max. seconds to wait for new data on the channel
+    """
+    while True:
+        readable, _, _ = select.select([channel], [], [], timeout)
+        if not readable:
+            raise socket.timeout("No output for {} secs".format(timeout))
+        while channel.recv_stderr_ready():
+            yield True, channel.recv_stderr(READ_SIZE)
+        while channel.recv_ready():
+            yield False, channel.recv(READ_SIZE)
+        if channel.eof_received and not channel.recv_ready() \
+                and not channel.recv_stderr_ready():
+            break
+
+
+def drain_channel(channel, timeout=600):
+    """
+    Read stdout and stderr of the channel concurrently until EOF
+    :param channel: paramiko.Channel object with an executed command
+    :param timeout: Max. seconds to wait for new data on the channel
+    :return: Tuple of (stdout bytearray, stderr bytearray, exit_status)
+    """
+    streams = {False: bytearray(), True: bytearray()}
+    for is_stderr, data in iter_channel(channel, timeout):
+        streams[is_stderr] += data
+    return streams[False], streams[True], channel.recv_exit_status()
+
+
+def decode_lines(data, encoding='utf-8'):
+    """
+    Split the complete output of a command into decoded lines. Decoding
+    happens after the split, so multi-byte characters are never broken.
+    """
+    return [line.decode(encoding, errors='replace')
+            for line in data.splitlines()]
+
+
+class LineSplitter(object):
+    """
+    Splits a stream of byte chunks into decoded lines, using the same
+    line boundaries as bytes.splitlines(). Newline bytes never occur inside
+    a multi-byte UTF-8 sequence, so decoding complete lines is safe even if
+    a character was split across two reads.
+    Only the current, incomplete line is kept in memory.
+    """
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.__pending = list()
+
+    def __decode(self, line):
+        return line.rstrip(b'\r\n').decode(self.encoding, errors='replace')
+
+    def feed(self, data):
+        """
+        :param data: Bytes received from the stream
+        :return: List of lines completed by this chunk
+        """
+        if b'\n' not in data and b'\r' not in data:
+            if data:
+                self.__pending.append(data)
+            return []
+        if self.__pending:
+            self.__pending.append(data)
+            data = b''.join(self.__pending)
+            self.__pending = list()
+        lines = data.splitlines(True)
+        last = lines[-1]
+        # A trailing '\r' may be the first half of a '\r\n' pair
+        if last.endswith(b'\r') or not last.endswith(b'\n'):
+            self.__pending.append(lines.pop())
+        return [self.__decode(line) for line in lines]
+
+    def flush(self):
+        """
+        :return: Remaining lines once the stream reached EOF
+        """
+        data = b''.join(self.__pending)
+        self.__pending = list()
+        return [self.__decode(line) for line in data.splitlines(True)]
+
+
+class CommandOutputStream(object):
+    """
+    Iterates over the stdout lines of a running command as they arrive.
+
+    Memory is bounded by the longest line. Only the last max_error_lines
+    lines of stderr are retained in self.error. self.exit_code is set once
+    the iteration is complete.
+    """
+    def __init__(self, timeout=600, on_close=None, max_error_lines=1000):
+        self.timeout = timeout
+        self.exit_code = None
+        self.error = deque(maxlen=max_error_lines)
+        self.__on_close = on_close
+        self.__closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        stdout = LineSplitter()
+        stderr = LineSplitter()
+        try:
+            for is_stderr, data in self._read_chunks():
+                if is_stderr:
+                    self.error.extend(stderr.feed(data))
+                else:
+                    for line in stdout.feed(data):
+                        yield line
+            for line in stdout.flush():
+                yield line
+            self.error.extend(stderr.flush())
+            self.exit_code = self._get_exit_code()
+        finally:
+            self.close()
+
+    def _read_chunks(self):
+        """Yields (is_stderr, data) tuples until the command ends"""
+        raise NotImplementedError
+
+    def _get_exit_code(self):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            self._close()
+        finally:
+            if self.__on_close is not None:
+                self.__on_close()
+
+
+class ChannelOutputStream(CommandOutputStream):
+    """CommandOutputStream over a paramiko.Channel running the command"""
+    def __init__(self, channel, timeout=600, on_close=None,
+                 max_error_lines=1000):
+        super(ChannelOutputStream, self).__init__(timeout, on_close,
+                                                  max_error_lines)
+        self.channel = channel
+
+    def _read_chunks(self):
+        return iter_channel(self.channel, self.timeout)
+
+    def _get_exit_code(self):
+        return self.channel.recv_exit_status()
+
+    def _close(self):
+        self.channel.close()
+
+
+class ProcessOutputStream(CommandOutputStream):
+    """CommandOutputStream over a local subprocess.Popen object"""
+    def __init__(self, process, timeout=600, on_close=None,
+                 max_error_lines=1000):
+        super(ProcessOutputStream, self).__init__(timeout, on_close,
+                                                  max_error_lines)
+        self.process = process
+
+    def _read_chunks(self):
+        fds = {self.process.stdout.fileno(): False,
+               self.process.stderr.fileno(): True}
+        while fds:
+            readable, _, _ = select.select(list(fds.keys()), [], [],
+                                           self.timeout)
+            if not readable:
+                raise socket.timeout("No output for {} secs"
+                                     .format(self.timeout))
+            for fd in readable:
+                data = os.read(fd, READ_SIZE)
+                if data:
+                    yield fds[fd], data
+                else:
+                    del fds[fd]
+
+    def _get_exit_code(self):
+        return self.process.wait()
+
+    def _close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
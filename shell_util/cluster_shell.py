@@ -0,0 +1,218 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from shell_util.remote_connection import RemoteMachineShellConnection
+from shell_util.tar_transfer import TarStreamTransfer
+
+log = logging.getLogger("shell_util")
+
+CommandResult = namedtuple("CommandResult",
+                           ["output", "error", "exit_code", "elapsed"])
+
+
+class ClusterShell(object):
+    """
+    Runs the same operation on a list of TestInputServer objects with
+    bounded concurrency, a per host timeout and an overall deadline.
+
+    The host timeout is a wall clock limit covering everything done for
+    the host, connecting included. A host exceeding it is reported as
+    failed and its connection gets closed, which aborts the operation
+    still running for it.
+
+    Shell connections are created on first use and kept for the next calls
+    until disconnect() is called.
+    """
+    # Secs between checks for hosts which started after the others
+    poll_interval = 0.1
+
+    def __init__(self, servers, max_workers=10, host_timeout=600,
+                 deadline=None):
+        """
+        :param servers: List of TestInputServer objects
+        :param max_workers: Max. number of hosts worked on in parallel
+        :param host_timeout: Max. seconds an operation may take on one host
+        :param deadline: Max. seconds a fan-out call may take in total.
+                         Defaults to host_timeout for every round of
+                         max_workers hosts, see get_deadline()
+        """
+        self.servers = servers
+        self.max_workers = max_workers
+        self.host_timeout = host_timeout
+        self.deadline = deadline
+        self.shells = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disconnect()
+
+    def get_shell(self, server):
+        if server.ip not in self.shells:
+            self.shells[server.ip] = RemoteMachineShellConnection(server)
+        return self.shells[server.ip]
+
+    def disconnect(self):
+        for shell in self.shells.values():
+            try:
+                shell.disconnect()
+            except Exception as e:
+                log.warning("Error while disconnecting shell: {}".format(e))
+        self.shells = dict()
+
+    def get_deadline(self, host_timeout=None):
+        """
+        :param host_timeout: Per host timeout. Defaults to self.host_timeout
+        :return: self.deadline or, if not set, the time needed when every
+                 host takes its full timeout
+        """
+        if self.deadline is not None:
+            return self.deadline
+        num_rounds = -(-len(self.servers) // max(1, self.max_workers))
+        return (host_timeout or self.host_timeout) * max(1, num_rounds)
+
+    def __abandon_shell(self, server):
+        shell = self.shells.pop(server.ip, None)
+        if shell is None:
+            return
+        # Closing the connection fails the call still blocked on it. Done
+        # in the background, disconnect() may wait for that call's lock
+        threading.Thread(target=shell.disconnect,
+                         name="cluster_shell_abandon", daemon=True).start()
+
+    def _fan_out(self, task, deadline=None, host_timeout=None):
+        """
+        Run task(server) for every server and collect the results
+        :param task: Callable returning a CommandResult for one server
+        :param deadline: Overrides the overall deadline for this call
+        :param host_timeout: Overrides self.host_timeout for this call
+        :return: Dict of server.ip -> CommandResult
+        """
+        host_timeout = host_timeout or self.host_timeout
+        if deadline is None:
+            deadline = self.get_deadline(host_timeout)
+        start_time = time.time()
+        start_times = dict()
+
+        def run(server):
+            start_times[server.ip] = time.time()
+            return task(server)
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(self.max_workers, len(self.servers))),
+            thread_name_prefix="cluster_shell")
+        futures = dict()
+        timed_out = set()
+        pending = set()
+        try:
+            for server in self.servers:
+                futures[executor.submit(run, server)] = server
+            pending = set(futures.keys())
+            while pending:
+                now = time.time()
+                wake_up = start_time + deadline
+                for future in list(pending):
+                    server = futures[future]
+                    if server.ip not in start_times:
+                        # Queued, its timeout starts once a worker is free.
+                        # Polled, nothing else wakes this loop up then
+                        wake_up = min(wake_up, now + self.poll_interval)
+                        continue
+                    expiry = start_times[server.ip] + host_timeout
+                    if now >= expiry:
+                        pending.discard(future)
+                        timed_out.add(future)
+                        self.__abandon_shell(server)
+                    else:
+                        wake_up = min(wake_up, expiry)
+                if not pending or now >= start_time + deadline:
+                    break
+                done, pending = wait(pending, timeout=wake_up - now,
+                                     return_when=FIRST_COMPLETED)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for future in pending:
+            if future.cancel():
+                continue
+            if not future.done():
+                # Still running at the deadline, don't reuse its connection
+                self.__abandon_shell(futures[future])
+
+        results = dict()
+        for future, server in futures.items():
+            if future in timed_out:
+                log.error("{} - Timeout of {} secs exceeded"
+                          .format(server.ip, host_timeout))
+                results[server.ip] = CommandResult(
+                    [], ["Timeout of {} secs exceeded".format(host_timeout)],
+                    None, time.time() - start_times[server.ip])
+            elif future.done() and not future.cancelled():
+                results[server.ip] = future.result()
+            else:
+                log.error("{} - Deadline of {} secs exceeded"
+                          .format(server.ip, deadline))
+                results[server.ip] = CommandResult(
+                    [], ["Deadline of {} secs exceeded".format(deadline)],
+                    None, time.time() - start_time)
+        return results
+
+    def execute_command(self, command, timeout=None, deadline=None,
+                        debug=False):
+        """
+        Run the command on all servers
+        :param command: Command to run
+        :param timeout: Per host timeout. Defaults to self.host_timeout
+        :param deadline: Overall deadline. Defaults to get_deadline()
+        :param debug: Log errors from the individual hosts
+        :return: Dict of server.ip -> CommandResult(output, error,
+                 exit_code, elapsed)
+        """
+        timeout = timeout or self.host_timeout
+
+        def run(server):
+            start_time = time.time()
+            try:
+                shell = self.get_shell(server)
+                output, error, exit_code = shell.execute_command(
+                    command, debug=debug, timeout=timeout, get_exit_code=True)
+            except Exception as e:
+                log.error("{} - '{}' failed: {}".format(server.ip, command, e))
+                output, error, exit_code = [], [str(e)], None
+            return CommandResult(output, error, exit_code,
+                                 time.time() - start_time)
+
+        return self._fan_out(run, deadline=deadline, host_timeout=timeout)
+
+    def fetch_tree(self, remote_dir, local_dir, include=None, compress=False,
+                   deadline=None):
+        """
+        Download remote_dir from all servers in parallel, each one into
+        local_dir/<server.ip>. See TarStreamTransfer.fetch_tree()
+        :param include: List of shell glob patterns relative to remote_dir.
+                        None for everything
+        :param compress: gzip the tar streams
+        :param deadline: Overall deadline. Defaults to get_deadline()
+        :return: Dict of server.ip -> CommandResult, with the names of the
+                 fetched entries as output and exit_code 0 on success
+        """
+        def run(server):
+            start_time = time.time()
+            try:
+                shell = self.get_shell(server)
+                output = TarStreamTransfer(
+                    shell, compress, timeout=self.host_timeout).fetch_tree(
+                    remote_dir, os.path.join(local_dir, server.ip), include)
+                error, exit_code = [], 0
+            except Exception as e:
+                log.error("{} - Fetching {} failed: {}"
+                          .format(server.ip, remote_dir, e))
+                output, error, exit_code = [], [str(e)], None
+            return CommandResult(output, error, exit_code,
+                                 time.time() - start_time)
+
+        return self._fan_out(run, deadline=deadline)
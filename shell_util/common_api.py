@@ -1,11 +1,67 @@
 import os
+import shlex
+import shutil
+import uuid
 from subprocess import PIPE, Popen
 from typing import re
 
+from paramiko import SSHException
+
+from shell_util.channel_reader import ChannelOutputStream, \
+    ProcessOutputStream, decode_lines, drain_channel, read_channel
+from shell_util.remote_config_file import RemoteConfigFile
 from shell_util.remote_machine import RemoteMachineProcess
+from shell_util.sftp_transfer import LocalDigestCache, ParallelUploader, \
+    ResumableTransfer, TransferProgress, get_remote_file_path
+from shell_util.tar_transfer import TarStreamTransfer
 
 
 class CommonShellAPIs(object):
+    def __run_local_command(self, command):
+        """
+        Run the command on the local machine, through the persistent local
+        shell session if enabled. Waits for the command without a timeout
+        :return: Tuple of (stdout bytes, stderr bytes, exit_code)
+        """
+        session = self.get_shell_session()
+        if session is not None:
+            # Non blocking, parallel callers fall back to their own shell
+            result = session.run(command, timeout=None, cwd=os.getcwd(),
+                                 blocking=False, env=dict(os.environ))
+            if result is not None:
+                return result
+        p = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
+        output, error = p.communicate()
+        return output, error, p.returncode
+
+    def __run_remote_command(self, command, timeout=600):
+        """
+        Run the command without a PTY, through the persistent shell session
+        if enabled or else on a new session channel
+        :return: Tuple of (stdout, stderr, exit_code)
+        """
+        session = self.get_shell_session()
+        if session is not None:
+            # The session's channel holds a session slot of its own
+            result = session.run(command, timeout, blocking=False)
+            if result is not None:
+                return result
+        with self._session_slots:
+            channel = self._ssh_client.get_transport().open_session()
+            try:
+                channel.exec_command(command)
+                channel.shutdown_write()
+                # Both streams are drained together before waiting
+                # for the exit status, so large outputs can't stall
+                return drain_channel(channel, timeout)
+            finally:
+                channel.close()
+
+    @staticmethod
+    def __is_plain_path(path):
+        # No globs, variables or whitespace which need a shell to expand
+        return shlex.quote(path) == path
+
     def get_running_processes(self):
         # if its linux ,then parse each line
         # 26989 ?        00:00:51 pdflush
@@ -73,22 +129,45 @@ class CommonShellAPIs(object):
         else:
             self.log.error("Couchbase server is failed to start!")
 
+    def __get_remote_file(self, sftp, src_file, dest_file, size):
+        self.log.info("Copying {} to {}".format(src_file, dest_file))
+        if size >= ResumableTransfer.min_size:
+            # Worth resuming, and verifying with a remote sha256
+            ResumableTransfer(self).get(src_file, dest_file)
+        else:
+            sftp.get(src_file, dest_file)
+
     def get_file(self, remotepath, filename, todir):
+        if self.remote and "Program" not in remotepath:
+            # Single listing, instead of file_exists() listing it first
+            sftp = self.get_sftp_client()
+            try:
+                attrs = sftp.listdir_attr(remotepath)
+                for attr in attrs:
+                    if filename in attr.filename and attr.st_size > 0:
+                        self.__get_remote_file(
+                            sftp, "{}/{}".format(remotepath, attr.filename),
+                            "{}/{}".format(todir, attr.filename),
+                            attr.st_size)
+                        return True
+            except IOError:
+                return False
+            if [attr for attr in attrs if filename in attr.filename]:
+                # Only empty files, file_exists() cleans them up
+                self.file_exists(remotepath, filename)
+            return False
         if self.file_exists(remotepath, filename):
             if self.remote:
-                sftp = self._ssh_client.open_sftp()
+                sftp = self.get_sftp_client()
                 try:
-                    filenames = sftp.listdir(remotepath)
-                    for name in filenames:
-                        if filename in name:
-                            src_file = "{}/{}".format(remotepath, name)
-                            dest_file = "{}/{}".format(todir, name)
-                            self.log.info("Copying {} to {}"
-                                          .format(src_file, dest_file))
-                            sftp.get(src_file, dest_file)
-                            sftp.close()
+                    for attr in sftp.listdir_attr(remotepath):
+                        if filename in attr.filename:
+                            self.__get_remote_file(
+                                sftp,
+                                "{}/{}".format(remotepath, attr.filename),
+                                "{}/{}".format(todir, attr.filename),
+                                attr.st_size)
                             return True
-                    sftp.close()
                     return False
                 except IOError:
                     return False
@@ -98,7 +177,7 @@ class CommonShellAPIs(object):
     def read_remote_file(self, remote_path, filename):
         if self.file_exists(remote_path, filename):
             if self.remote:
-                sftp = self._ssh_client.open_sftp()
+                sftp = self.get_sftp_client()
                 remote_file = sftp.open('{0}/{1}'.format(remote_path, filename))
                 try:
                     out = remote_file.readlines()
@@ -129,18 +208,21 @@ class CommonShellAPIs(object):
 
     def remove_directory(self, remote_path):
         if self.remote:
-            sftp = self._ssh_client.open_sftp()
+            sftp = self.get_sftp_client()
             try:
                 self.log.info("removing {0} directory...".format(remote_path))
                 sftp.rmdir(remote_path)
             except IOError:
                 return False
-            finally:
-                sftp.close()
+        elif self.__is_plain_path(remote_path):
+            if os.path.isdir(remote_path) \
+                    and not os.path.islink(remote_path):
+                shutil.rmtree(remote_path, ignore_errors=True)
+            elif os.path.lexists(remote_path):
+                os.remove(remote_path)
         else:
             try:
-                p = Popen("rm -rf {0}".format(remote_path), shell=True, stdout=PIPE, stderr=PIPE)
-                stdout, stderro = p.communicate()
+                self.__run_local_command("rm -rf {0}".format(remote_path))
             except IOError:
                 return False
         return True
@@ -162,44 +244,46 @@ class CommonShellAPIs(object):
 
     def remove_directory_recursive(self, remote_path):
         if self.remote:
-            sftp = self._ssh_client.open_sftp()
+            sftp = self.get_sftp_client()
             try:
                 self.log.info("removing {0} directory...".format(remote_path))
                 self.rmtree(sftp, remote_path)
             except IOError:
                 return False
-            finally:
-                sftp.close()
         else:
-            try:
-                p = Popen("rm -rf {0}".format(remote_path), shell=True, stdout=PIPE, stderr=PIPE)
-                p.communicate()
-            except IOError:
-                return False
+            return self.remove_directory(remote_path)
         return True
 
     def list_files(self, remote_path):
         if self.remote:
-            sftp = self._ssh_client.open_sftp()
+            sftp = self.get_sftp_client()
             files = []
             try:
                 file_names = sftp.listdir(remote_path)
                 for name in file_names:
                     files.append({'path': remote_path, 'file': name})
-                sftp.close()
             except IOError:
                 return []
             return files
+        elif self.__is_plain_path(remote_path):
+            # Same output as 'ls <remote_path>'
+            if os.path.isdir(remote_path):
+                names = sorted([name for name in os.listdir(remote_path)
+                                if not name.startswith('.')])
+            elif os.path.lexists(remote_path):
+                names = [remote_path]
+            else:
+                names = []
+            return "".join([name + "\n" for name in names]).encode()
         else:
-            p = Popen("ls {0}".format(remote_path), shell=True, stdout=PIPE, stderr=PIPE)
-            files, stderro = p.communicate()
+            files, _, _ = self.__run_local_command("ls {0}".format(remote_path))
             return files
 
     def file_ends_with(self, remotepath, pattern):
         """
          Check if file ending with this pattern is present in remote machine
         """
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         files_matched = []
         try:
             file_names = sftp.listdir(remotepath)
@@ -209,7 +293,6 @@ class CommonShellAPIs(object):
         except IOError:
             # ignore this error
             pass
-        sftp.close()
         if len(files_matched) > 0:
             self.log.info("found these files : {0}".format(files_matched))
         return files_matched
@@ -217,7 +300,7 @@ class CommonShellAPIs(object):
     # check if this file exists in the remote
     # machine or not
     def file_starts_with(self, remotepath, pattern):
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         files_matched = []
         try:
             file_names = sftp.listdir(remotepath)
@@ -227,13 +310,12 @@ class CommonShellAPIs(object):
         except IOError:
             # ignore this error
             pass
-        sftp.close()
         if len(files_matched) > 0:
             self.log.info("found these files : {0}".format(files_matched))
         return files_matched
 
     def file_exists(self, remotepath, filename, pause_time=30):
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         try:
             if "Program" in remotepath:
                 if "Program\\" in remotepath:
@@ -247,7 +329,6 @@ class CommonShellAPIs(object):
             filenames = sftp.listdir_attr(remotepath)
             for name in filenames:
                 if filename in name.filename and int(name.st_size) > 0:
-                    sftp.close()
                     return True
                 elif filename in name.filename and int(name.st_size) == 0:
                     if name.filename == NR_INSTALL_LOCATION_FILE:
@@ -260,13 +341,12 @@ class CommonShellAPIs(object):
                                            "\nWait {0} seconds before executing next instrucion"\
                                                                              .format(pause_time))
 
-            sftp.close()
             return False
         except IOError:
             return False
 
     def delete_file(self, remotepath, filename):
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         delete_file = False
         try:
             filenames = sftp.listdir_attr(remotepath)
@@ -284,53 +364,143 @@ class CommonShellAPIs(object):
                         self.log.error("fail to remove file %s " % filename)
                         delete_file = False
                         break
-            sftp.close()
             return delete_file
         except IOError:
             return False
 
-    def copy_file_local_to_remote(self, src_path, des_path):
-        result = True
-        sftp = self._ssh_client.open_sftp()
+    def is_same_remote_file(self, src_path, des_path):
+        """
+        Check whether the remote file has the content of the local one.
+        Equal size and mtime count as identical, otherwise the sha256 of
+        the remote file is compared against the (cached) local digest
+        :param src_path: Local file path
+        :param des_path: Remote file path or an existing remote directory
+        :return: True if the remote file is identical
+        """
+        sftp = self.get_sftp_client()
+        des_path = get_remote_file_path(sftp, src_path, des_path)
         try:
-            sftp.put(src_path, des_path)
+            attr = sftp.stat(des_path)
         except IOError:
-            self.log.error('Can not copy file')
+            return False
+        st = os.stat(src_path)
+        if attr.st_size != st.st_size:
+            return False
+        if attr.st_mtime == int(st.st_mtime):
+            return True
+        remote_digest = ResumableTransfer(self).get_remote_digest(des_path)
+        if remote_digest is None \
+                or remote_digest != LocalDigestCache.get(src_path):
+            return False
+        # Matches on size and mtime next time
+        sftp.utime(des_path, (int(st.st_atime), int(st.st_mtime)))
+        return True
+
+    def copy_file_local_to_remote(self, src_path, des_path, callback=None,
+                                  resume=False, skip_if_same=False):
+        """
+        Upload a file. Large files are sent in ranges over several SFTP
+        sessions, see ParallelUploader
+        :param src_path: Local file path
+        :param des_path: Remote file path or an existing remote directory
+        :param callback: Optional progress callback, called with
+                         (transferred_bytes, total_bytes, bytes_per_sec)
+        :param resume: Continue an interrupted upload and verify the
+                       sha256 of the result, see ResumableTransfer
+        :param skip_if_same: Don't upload if the remote file is identical,
+                             see is_same_remote_file()
+        :return: True on success
+        """
+        result = True
+        try:
+            if skip_if_same and self.is_same_remote_file(src_path, des_path):
+                self.log.info("{} - {} is already present in {}, "
+                              "skipping copy"
+                              .format(self.ip, src_path, des_path))
+                return result
+            if resume:
+                ResumableTransfer(self, callback).put(src_path, des_path)
+            else:
+                ParallelUploader(self, callback).upload(src_path, des_path)
+            if skip_if_same:
+                st = os.stat(src_path)
+                sftp = self.get_sftp_client()
+                sftp.utime(get_remote_file_path(sftp, src_path, des_path),
+                           (int(st.st_atime), int(st.st_mtime)))
+        except (IOError, SSHException) as e:
+            self.log.error('Can not copy file: {}'.format(e))
             result = False
-        finally:
-            sftp.close()
         return result
 
-    def copy_file_remote_to_local(self, rem_path, des_path):
+    def copy_file_remote_to_local(self, rem_path, des_path, callback=None,
+                                  resume=False):
+        """
+        :param callback: Optional progress callback, called with
+                         (transferred_bytes, total_bytes, bytes_per_sec)
+        :param resume: Continue an interrupted download and verify the
+                       sha256 of the result, see ResumableTransfer
+        """
         result = True
-        sftp = self._ssh_client.open_sftp()
         try:
-            sftp.get(rem_path, des_path)
+            if resume:
+                ResumableTransfer(self, callback).get(rem_path, des_path)
+            else:
+                sftp = self.get_sftp_client()
+                progress = TransferProgress(sftp.stat(rem_path).st_size,
+                                            callback)
+                sftp.get(rem_path, des_path,
+                         callback=progress.get_sftp_callback())
         except IOError as e:
             self.log.error('Can not copy file', e)
             result = False
-        finally:
-            sftp.close()
         return result
 
     # copy multi files from local to remote server
-    def copy_files_local_to_remote(self, src_path, des_path):
-        files = os.listdir(src_path)
+    def copy_files_local_to_remote(self, src_path, des_path, compress=False):
+        """
+        Copy the content of a local directory into the remote directory,
+        streamed as one tar archive, see TarStreamTransfer.
+        Falls back to copying file by file if that fails
+        :param compress: gzip the tar stream
+        :return: True on success
+        """
         self.log.info("copy files from {0} to {1}".format(src_path, des_path))
-        # self.execute_batch_command("cp -r  {0}/* {1}".format(src_path, des_path))
-        for file in files:
-            if file.find("wget") != 1:
-                a = ""
+        try:
+            TarStreamTransfer(self, compress).put_tree(src_path, des_path)
+            return True
+        except (IOError, SSHException) as e:
+            self.log.warning("Tar stream copy failed, copying file by file: "
+                             "{}".format(e))
+        result = True
+        for file in os.listdir(src_path):
             full_src_path = os.path.join(src_path, file)
             full_des_path = os.path.join(des_path, file)
-            self.copy_file_local_to_remote(full_src_path, full_des_path)
+            result = self.copy_file_local_to_remote(full_src_path,
+                                                    full_des_path) and result
+        return result
+
+    def fetch_tree(self, remote_dir, local_dir, include=None, compress=False):
+        """
+        Download a remote directory (logs, crash dumps, cbcollect_info
+        output) as one tar stream, see TarStreamTransfer.fetch_tree()
+        :param include: List of shell glob patterns relative to remote_dir.
+                        None for everything
+        :param compress: gzip the tar stream
+        :return: List of the names of the fetched entries, None on failure
+        """
+        try:
+            return TarStreamTransfer(self, compress).fetch_tree(
+                remote_dir, local_dir, include)
+        except (IOError, SSHException) as e:
+            self.log.error("Unable to fetch {}: {}".format(remote_dir, e))
+            return None
 
     # create a remote file from input string
     def create_file(self, remote_path, file_data):
         output, error = self.execute_command("echo '{0}' > {1}".format(file_data, remote_path))
 
     def find_file(self, remote_path, file):
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         try:
             files = sftp.listdir(remote_path)
             for name in files:
@@ -345,10 +515,9 @@ class CommonShellAPIs(object):
                 self.log.error('Can not find {0}'.format(file))
         except IOError:
             pass
-        sftp.close()
 
     def create_directory(self, remote_path):
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         try:
             self.log.info("Checking if the directory {0} exists or not.".format(remote_path))
             sftp.stat(remote_path)
@@ -356,7 +525,6 @@ class CommonShellAPIs(object):
             if e.errno == 2:
                 self.log.info("Directory at {0} DOES NOT exist. We will create on here".format(remote_path))
                 sftp.mkdir(remote_path)
-                sftp.close()
                 return False
             raise
         else:
@@ -364,21 +532,18 @@ class CommonShellAPIs(object):
             return True
 
     def check_directory_exists(self, remote_path):
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         try:
             self.log.info("Checking if the directory {0} exists or not.".format(remote_path))
             sftp.stat(remote_path)
         except IOError as e:
             self.log.info(f'Directory at {remote_path} DOES NOT exist.')
-            sftp.close()
             return False
         self.log.info("Directory at {0} exist.")
-        sftp.close()
         return True
 
     # this function will remove the automation directory in windows
     def create_multiple_dir(self, dir_paths):
-        sftp = self._ssh_client.open_sftp()
         try:
             for dir_path in dir_paths:
                 if dir_path != '/cygdrive/c/tmp':
@@ -388,7 +553,6 @@ class CommonShellAPIs(object):
                     else:
                         self.log.error("Can not delete {0} directory or directory {0} does not exist.".format(dir_path))
                 self.create_directory(dir_path)
-            sftp.close()
         except IOError:
             pass
 
@@ -576,7 +740,7 @@ class CommonShellAPIs(object):
         if not(query == ""):
             main_command = main_command + " -s=\"" + query + '"'
         elif self.remote and not(queries == ""):
-            sftp = self._ssh_client.open_sftp()
+            sftp = self.get_sftp_client()
             filein = sftp.open(filename, 'w')
             for query in queries:
                 filein.write(query)
@@ -653,7 +817,6 @@ class CommonShellAPIs(object):
             self.sleep(1)
         if self.remote and not(queries == ""):
             sftp.remove(filename)
-            sftp.close()
         elif not(queries == ""):
             os.remove(filename)
 
@@ -675,6 +838,71 @@ class CommonShellAPIs(object):
             command, debug=debug, use_channel=use_channel,
             timeout=timeout, get_exit_code=get_exit_code)
 
+    def execute_commands_batch(self, commands, stop_on_failure=False,
+                               debug=True, use_channel=False, timeout=600):
+        """
+        Run a list of commands using a single remote invocation.
+        Each command runs in its own subshell, like execute_command() would.
+        :param commands: List of commands to run in the given order
+        :param stop_on_failure: If True, commands after the first one
+                                exiting with non-zero status are not run
+        :param debug: Log the errors of the commands
+        :param use_channel: Run the batch in a PTY (stderr goes to stdout)
+        :param timeout: Max. secs to wait for new output
+        :return: List of (output, error, exit_code) tuples, one per command
+                 which got executed. output / error are lists of lines
+        """
+        if not commands:
+            return []
+        if self.info is not None and self.info.type.lower() == 'windows':
+            self.use_sudo = False
+        use_sudo = getattr(self, "use_sudo", False)
+        merged_stderr = self.remote and (use_sudo or use_channel)
+        marker = "__ssh_util_batch_{}__".format(uuid.uuid4().hex)
+        script = list()
+        for command in commands:
+            if use_sudo:
+                command = "sudo " + command
+            script.append("( eval {} ) </dev/null".format(shlex.quote(command)))
+            script.append("rc=$?; printf '\\n{} %d\\n' $rc".format(marker))
+            if not merged_stderr:
+                script.append("printf '\\n{}\\n' >&2".format(marker))
+            if stop_on_failure:
+                script.append("[ $rc -eq 0 ] || exit $rc")
+        output, error = self.execute_command_raw(
+            "sh -c {}".format(shlex.quote("\n".join(script))), debug=False,
+            use_channel=use_channel, timeout=timeout)
+        if isinstance(output, bytes):
+            output = output.decode(errors='replace')
+            error = error.decode(errors='replace')
+        else:
+            output = "\n".join(output)
+            error = "\n".join(error)
+
+        # Piece i+1 starts with the exit code of command i, followed by the
+        # output of command i+1
+        out_pieces = output.split("\n{} ".format(marker))
+        err_pieces = error.split("\n{}".format(marker))
+        results = list()
+        for index in range(len(out_pieces) - 1):
+            command_out = out_pieces[index]
+            if index > 0:
+                command_out = command_out.partition("\n")[2]
+            exit_code = int(out_pieces[index + 1].partition("\n")[0])
+            command_err = ""
+            if index < len(err_pieces) and not merged_stderr:
+                command_err = err_pieces[index]
+                if index > 0 and command_err.startswith("\n"):
+                    command_err = command_err[1:]
+            command_out = command_out.splitlines()
+            command_err = command_err.splitlines()
+            if debug and command_err:
+                self.log.info("{} - '{}' exited with {}, error {} ..."
+                              .format(self.ip, commands[index], exit_code,
+                                      str(command_err)[:400]))
+            results.append((command_out, command_err, exit_code))
+        return results
+
     def reconnect_if_inactive(self):
         """
         If the SSH channel is inactive, retry the connection
@@ -691,53 +919,80 @@ class CommonShellAPIs(object):
         self.reconnect_if_inactive()
         output = []
         error = []
-        temp = ''
-        p, stdout, exit_code = None, None, None
-        if self.remote and self.use_sudo or use_channel:
-            channel = self._ssh_client.get_transport().open_session()
-            channel.get_pty()
-            channel.settimeout(900)
-            stdin = channel.makefile('wb')
-            stdout = channel.makefile('rb')
-            stderro = channel.makefile_stderr('rb')
-            channel.exec_command(command)
-            data = channel.recv(1024)
-            while data:
-                temp += data.decode()
-                data = channel.recv(1024)
-            channel.close()
-            stdin.close()
-        elif self.remote:
-            stdin, stdout, stderro = self._ssh_client.exec_command(
-                command, timeout=timeout)
-            stdin.close()
-
+        exit_code = None
         if not self.remote:
-            p = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-            output, error = p.communicate()
-
-        if get_exit_code:
-            if stdout:
-                exit_code = stdout.channel.recv_exit_status()
-            if p:
-                exit_code = p.returncode
-
-        if self.remote:
-            for line in stdout.read().splitlines():
-                output.append(line.decode('utf-8', errors='replace'))
-            for line in stderro.read().splitlines():
-                error.append(line.decode('utf-8', errors='replace'))
-            if temp:
-                line = temp.splitlines()
-                output.extend(line)
-            stdout.close()
-            stderro.close()
+            output, error, status = self.__run_local_command(command)
+            if get_exit_code:
+                exit_code = status
+        else:
+            # Each call runs on its own channel of the shared transport
+            # (or the persistent shell session's channel).
+            # Slots are bounded to stay within the server's MaxSessions
+            if self.use_sudo or use_channel:
+                with self._session_slots:
+                    # PTY merges stderr into stdout, so only one stream to read
+                    channel = self._ssh_client.get_transport().open_session()
+                    channel.get_pty()
+                    channel.settimeout(900)
+                    channel.exec_command(command)
+                    output = decode_lines(read_channel(channel))
+                    if get_exit_code:
+                        exit_code = channel.recv_exit_status()
+                    channel.close()
+            else:
+                stdout, stderro, status = \
+                    self.__run_remote_command(command, timeout)
+                if get_exit_code:
+                    exit_code = status
+                output = decode_lines(stdout)
+                error = decode_lines(stderro)
         if debug:
             if len(error):
                 self.log.info('command executed with {} but got an error {} ...'.format(
                     self.server.ssh_username, str(error)[:400]))
         return (output, error, exit_code) if get_exit_code else (output, error)
 
+    def execute_command_stream(self, command, use_channel=False,
+                               timeout=600):
+        """
+        Run the command and yield its stdout lines as they arrive instead
+        of buffering the whole output in memory.
+
+        Usage:
+            with shell.execute_command_stream("journalctl") as stream:
+                for line in stream:
+                    ...
+            stream.exit_code, stream.error
+
+        :param command: Command to run
+        :param use_channel: Allocate a PTY for the command
+        :param timeout: Max. seconds to wait for new output
+        :return: CommandOutputStream object. exit_code and error
+                 (last stderr lines) are available once it is exhausted
+        """
+        if getattr(self, "info", None) is not None \
+                and self.info.type.lower() == 'windows':
+            self.use_sudo = False
+        if self.use_sudo:
+            command = "sudo " + command
+        self.log.debug("%s - Running command.stream: %s" % (self.ip, command))
+        if not self.remote:
+            p = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
+            return ProcessOutputStream(p, timeout=timeout)
+
+        self.reconnect_if_inactive()
+        self._session_slots.acquire()
+        try:
+            channel = self._ssh_client.get_transport().open_session()
+            if self.use_sudo or use_channel:
+                channel.get_pty()
+            channel.exec_command(command)
+        except Exception:
+            self._session_slots.release()
+            raise
+        return ChannelOutputStream(channel, timeout=timeout,
+                                   on_close=self._session_slots.release)
+
     def execute_non_sudo_command(self, command, info=None, debug=True,
                                  use_channel=False):
         return self.execute_command_raw(command, debug=debug,
@@ -923,9 +1178,10 @@ class CommonShellAPIs(object):
         self.stop_couchbase()
 
         # Edit _start function
-        cmd = r"sed -i 's/\(.*\-run ns_bootstrap.*\)/\1\n\t-name ns_1@{0} \\/' \
-                /opt/couchbase/bin/couchbase-server".format(name)
-        self.execute_command(cmd)
+        with RemoteConfigFile(self, "/opt/couchbase/bin/couchbase-server") \
+                as init_script:
+            init_script.substitute(r"(.*-run ns_bootstrap.*)",
+                                   r"\1\n\t-name ns_1@{0} \\".format(name))
 
         # Cleanup
         for cmd in ('rm -fr /opt/couchbase/var/lib/couchbase/data/*',
@@ -0,0 +1,181 @@
+import logging
+import time
+import weakref
+from threading import Condition, Event, Lock, Thread
+
+from paramiko import Message
+from paramiko.common import (MSG_REQUEST_FAILURE, MSG_REQUEST_SUCCESS,
+                             cMSG_GLOBAL_REQUEST)
+
+log = logging.getLogger("shell_util")
+
+# Transport -> ProbeReplies of it
+_probe_replies = weakref.WeakKeyDictionary()
+_probe_replies_lock = Lock()
+
+
+class ProbeReplies(object):
+    """
+    Counts the server's replies to the keepalive requests sent on a
+    paramiko Transport.
+
+    paramiko's global_request(wait=True) waits on transport.completion_event,
+    which is also set by key exchanges and replaced by them, so a probe
+    running during a rekey could return before the server replied or end
+    the rekey's wait instead. The probes are therefore sent without going
+    through global_request() and their replies are taken off the transport's
+    handlers for global request replies before paramiko sees them.
+    Servers reply to global requests in the order they were sent, so the
+    n-th reply answers the n-th probe. This relies on no other global
+    requests waiting for a reply (port forwarding) being made on the
+    transport, this library doesn't make any.
+    """
+    def __init__(self, transport):
+        self.cond = Condition()
+        # Held while a probe is being sent, sending blocks during a rekey
+        self.send_lock = Lock()
+        self.sent = 0
+        self.received = 0
+        handlers = transport._handler_table
+        for ptype in (MSG_REQUEST_SUCCESS, MSG_REQUEST_FAILURE):
+            handlers[ptype] = self.__get_handler(handlers[ptype])
+
+    def __get_handler(self, handler):
+        def on_reply(msg):
+            with self.cond:
+                if self.received < self.sent:
+                    # Success or failure, both prove the server is alive
+                    self.received += 1
+                    self.cond.notify_all()
+                    return
+            handler(msg)
+        return on_reply
+
+    @staticmethod
+    def get(transport):
+        """
+        :return: ProbeReplies object of the transport, None if it isn't a
+                 paramiko Transport (OpenSSH backend)
+        """
+        if not isinstance(getattr(transport, "_handler_table", None), dict):
+            return None
+        with _probe_replies_lock:
+            if transport not in _probe_replies:
+                _probe_replies[transport] = ProbeReplies(transport)
+            return _probe_replies[transport]
+
+    def send(self, transport):
+        """
+        Send a keepalive request the server has to reply to
+        :return: Number of replies to wait for
+        """
+        msg = Message()
+        msg.add_byte(cMSG_GLOBAL_REQUEST)
+        msg.add_string("keepalive@openssh.com")
+        msg.add_boolean(True)
+        with self.cond:
+            self.sent += 1
+            num = self.sent
+        transport._send_user_message(msg)
+        return num
+
+    def wait(self, num, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.received >= num, timeout)
+
+
+def _send_probe(transport, replies, result):
+    try:
+        if replies is None:
+            # OpenSSH backend, checks the master. The master exits once the
+            # server stops answering its ServerAliveInterval keepalives
+            transport.send_ignore()
+            result.append(0)
+        else:
+            result.append(replies.send(transport))
+    except Exception as e:
+        log.debug("SSH keepalive request failed: {}".format(e))
+    finally:
+        if replies is not None:
+            replies.send_lock.release()
+
+
+def probe_transport(transport, timeout=10):
+    """
+    Round trip check of an SSH transport, the way OpenSSH's
+    ServerAliveInterval does it: a global request the server has to reply
+    to, see ProbeReplies. Unlike transport.is_active() this detects a peer
+    which stopped responding without closing the TCP connection.
+    A probe which can't be sent in time (rekey with a dead peer) keeps
+    trying in the background till the transport gets closed, further
+    probes of the transport fail meanwhile.
+    :param transport: paramiko.Transport (or compatible) object
+    :param timeout: Secs to wait for the server's reply
+    :return: True if the server replied within the timeout
+    """
+    if transport is None or not transport.is_active():
+        return False
+    end_time = time.time() + timeout
+    replies = ProbeReplies.get(transport)
+    if replies is not None and not replies.send_lock.acquire(timeout=timeout):
+        return False
+    result = list()
+    probe = Thread(target=_send_probe, args=(transport, replies, result),
+                   name="ssh_probe")
+    probe.daemon = True
+    probe.start()
+    probe.join(max(0, end_time - time.time()))
+    if not result:
+        return False
+    if replies is not None and not replies.wait(
+            result[0], max(0, end_time - time.time())):
+        return False
+    return transport.is_active()
+
+
+class ConnectionMonitor(Thread):
+    """
+    Background thread probing the SSH transport of a ShellConnection.
+
+    A half-open TCP session (node reboot, network fault) is not noticed by
+    paramiko until a write fails, so commands on such a transport hang till
+    their timeout. The monitor sends a keepalive request every 'interval'
+    seconds (see probe_transport()); if the server does not answer within
+    'probe_timeout' the transport is torn down and rebuilt before the next
+    command needs it.
+    """
+    def __init__(self, shell, interval=30, probe_timeout=10):
+        super(ConnectionMonitor, self).__init__()
+        self.daemon = True
+        self.name = "ssh_monitor_{}".format(shell.ip)
+        # Weak reference, so the monitor doesn't keep the shell object alive
+        self.shell_ref = weakref.ref(shell)
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self.stop_event = Event()
+        self.reconnects = 0
+
+    def stop(self):
+        self.stop_event.set()
+
+    def check(self, shell):
+        if shell.is_connection_alive(self.probe_timeout) \
+                or self.stop_event.is_set():
+            return
+        log.warning("{} - SSH liveness probe failed, rebuilding connection"
+                    .format(shell.ip))
+        try:
+            shell.rebuild_connection()
+            self.reconnects += 1
+        except Exception as e:
+            log.error("{} - Failed to rebuild SSH connection: {}"
+                      .format(shell.ip, e))
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            shell = self.shell_ref()
+            if shell is None:
+                break
+            self.check(shell)
+            # Drop the strong reference before sleeping again
+            del shell
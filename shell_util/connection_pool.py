@@ -0,0 +1,176 @@
+import atexit
+import hashlib
+import logging
+import threading
+import time
+
+from shell_util.connection_monitor import probe_transport
+
+log = logging.getLogger("shell_util")
+
+
+class SSHConnectionPool(object):
+    """
+    Process wide pool of authenticated paramiko.SSHClient objects.
+
+    Clients are leased per (ip, port, ssh_username, credentials) key.
+    ShellConnection.disconnect() hands its client back to the pool and the
+    next connection to the same host / user picks it up again without a new
+    SSH handshake.
+
+    Disabled by default, since idle clients keep their sessions on the
+    servers open for up to max_idle_time secs. Enable it with:
+
+        SSHConnectionPool.enabled = True
+    """
+    enabled = False
+    # Seconds an idle client is kept before it gets closed
+    max_idle_time = 300
+    # Secs to wait for the server's reply when checking an idle client
+    probe_timeout = 5
+    # Max. number of idle clients retained for a single key
+    max_per_host = 4
+
+    __lock = threading.Lock()
+    # key -> list of (client, released_at) tuples, most recent one last
+    __idle = dict()
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    def get_key(ip, ssh_username, ssh_key, port=22, client_type='',
+                profile='', ssh_password=None):
+        # Only a digest of the password is kept in the key
+        password_digest = ''
+        if ssh_password:
+            password_digest = hashlib.sha256(
+                ssh_password.encode("utf-8")).hexdigest()
+        return ip.replace('[', '').replace(']', ''), port, ssh_username, \
+            ssh_key or '', password_digest, client_type, profile
+
+    @staticmethod
+    def is_healthy(client, probe_timeout=None):
+        """
+        Check whether the given client still holds an usable session
+        :param client: paramiko.SSHClient object
+        :param probe_timeout: If set, also wait up to this many secs for
+                              the server to answer a keepalive request,
+                              see probe_transport()
+        :return: True if the transport is active and authenticated
+        """
+        tp = client.get_transport()
+        if tp is None or not tp.is_active() or not tp.is_authenticated():
+            return False
+        if probe_timeout is not None:
+            return probe_transport(tp, probe_timeout)
+        return True
+
+    @staticmethod
+    def __close(client):
+        try:
+            client.close()
+        except Exception as e:
+            log.debug("Error while closing pooled SSH client: {}".format(e))
+
+    @classmethod
+    def __pop_expired(cls, now):
+        expired = list()
+        for key in list(cls.__idle.keys()):
+            alive = list()
+            for client, released_at in cls.__idle[key]:
+                if now - released_at > cls.max_idle_time:
+                    expired.append(client)
+                else:
+                    alive.append((client, released_at))
+            if alive:
+                cls.__idle[key] = alive
+            else:
+                del cls.__idle[key]
+        return expired
+
+    @classmethod
+    def acquire(cls, key):
+        """
+        Lease an idle, healthy client for the given key
+        :param key: Key returned by get_key()
+        :return: paramiko.SSHClient object or None if nothing is available
+        """
+        if not cls.enabled:
+            return None
+        while True:
+            with cls.__lock:
+                expired = cls.__pop_expired(time.time())
+                clients = cls.__idle.get(key)
+                client = clients.pop()[0] if clients else None
+                if clients is not None and not clients:
+                    del cls.__idle[key]
+            for t_client in expired:
+                cls.__close(t_client)
+            if client is None:
+                cls.misses += 1
+                return None
+            # Round trip, a half-open connection still looks active
+            if cls.is_healthy(client, cls.probe_timeout):
+                cls.hits += 1
+                log.debug("Reusing pooled SSH connection for {}"
+                          .format(key[0]))
+                return client
+            log.debug("Dropping stale pooled SSH connection for {}"
+                      .format(key[0]))
+            cls.__close(client)
+
+    @classmethod
+    def release(cls, key, client):
+        """
+        Return a client to the pool. Unhealthy clients and the ones above
+        max_per_host are closed instead.
+        :param key: Key returned by get_key()
+        :param client: paramiko.SSHClient object
+        :return: True if the client was retained by the pool
+        """
+        retained = False
+        to_close = list()
+        if cls.enabled and cls.is_healthy(client):
+            with cls.__lock:
+                to_close = cls.__pop_expired(time.time())
+                clients = cls.__idle.setdefault(key, list())
+                if len(clients) < cls.max_per_host:
+                    clients.append((client, time.time()))
+                    retained = True
+        if not retained:
+            to_close.append(client)
+        for t_client in to_close:
+            cls.__close(t_client)
+        return retained
+
+    @classmethod
+    def evict_idle(cls):
+        """Close all clients which crossed max_idle_time"""
+        with cls.__lock:
+            expired = cls.__pop_expired(time.time())
+        for client in expired:
+            cls.__close(client)
+
+    @classmethod
+    def clear(cls, ip=None):
+        """
+        Close idle clients of the given host or all of them
+        :param ip: Host to clear. Clears the complete pool when None
+        """
+        to_close = list()
+        with cls.__lock:
+            for key in list(cls.__idle.keys()):
+                if ip is None or key[0] == ip.replace('[', '').replace(']', ''):
+                    to_close.extend([c for c, _ in cls.__idle.pop(key)])
+        for client in to_close:
+            cls.__close(client)
+
+    @classmethod
+    def idle_count(cls, key=None):
+        with cls.__lock:
+            if key is not None:
+                return len(cls.__idle.get(key, []))
+            return sum([len(c) for c in cls.__idle.values()])
+
+
+atexit.register(SSHConnectionPool.clear)
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+from shell_util.remote_machine import RemoteMachineInfo
+
+log = logging.getLogger("shell_util")
+
+
+def _encode_value(value):
+    """
+    JSON has no tuples (RemoteMachineInfo.domain is one), they are stored
+    as {"__tuple__": [...]} to get them back as tuples
+    """
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode_value(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _encode_value(item))
+                    for key, item in value.items())
+    return value
+
+
+def _decode_object(obj):
+    if list(obj.keys()) == ["__tuple__"]:
+        return tuple(obj["__tuple__"])
+    return obj
+
+
+class RemoteMachineInfoCache(object):
+    """
+    On-disk cache of RemoteMachineInfo objects, shared across processes.
+
+    One JSON file per ip is stored under cache_dir. An entry is only used
+    if the host key fingerprint of the node still matches (a reinstalled /
+    replaced VM gets a new host key) and it is younger than ttl secs.
+    """
+    default_dir = os.path.join(os.path.expanduser("~"), ".cache", "ssh_util",
+                               "remote_info")
+    # Entries written with another version of the format are ignored
+    format_version = 2
+
+    def __init__(self, cache_dir=None, ttl=86400):
+        """
+        :param cache_dir: Directory holding the cache files
+        :param ttl: Max. age of an entry in secs
+        """
+        self.cache_dir = cache_dir or self.default_dir
+        self.ttl = ttl
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __get_path(self, ip):
+        file_name = re.sub(r'[^0-9A-Za-z._-]', '_', ip)
+        return os.path.join(self.cache_dir, "{}.json".format(file_name))
+
+    def get(self, ip, fingerprint):
+        """
+        :param ip: IP of the node
+        :param fingerprint: Host key fingerprint of the node
+        :return: RemoteMachineInfo object or None on cache miss
+        """
+        try:
+            with open(self.__get_path(ip)) as fp:
+                entry = json.load(fp, object_hook=_decode_object)
+        except (IOError, ValueError):
+            return None
+        if entry.get("version") != self.format_version:
+            log.debug("{} - Cached info has an old format".format(ip))
+            return None
+        if entry.get("fingerprint") != fingerprint:
+            log.debug("{} - Host key changed, ignoring cached info".format(ip))
+            return None
+        if time.time() - entry.get("saved_at", 0) > self.ttl:
+            log.debug("{} - Cached info expired".format(ip))
+            return None
+        info = RemoteMachineInfo()
+        info.__dict__.update(entry["info"])
+        return info
+
+    def put(self, ip, fingerprint, info):
+        entry = {"version": self.format_version,
+                 "fingerprint": fingerprint,
+                 "saved_at": time.time(),
+                 "info": _encode_value(info.__dict__)}
+        file_path = self.__get_path(ip)
+        tmp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, "w") as fp:
+                json.dump(entry, fp)
+            os.replace(tmp_path, file_path)
+        except (IOError, TypeError, ValueError) as e:
+            log.warning("{} - Unable to cache remote info: {}".format(ip, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete(self, ip):
+        try:
+            os.remove(self.__get_path(ip))
+        except OSError:
+            pass
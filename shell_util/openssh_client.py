@@ -0,0 +1,414 @@
+import getpass
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired
+
+import paramiko
+from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
+from paramiko.hostkeys import HostKeyEntry
+from paramiko.pipe import make_pipe
+
+from shell_util.channel_reader import READ_SIZE
+
+log = logging.getLogger("shell_util")
+
+
+class OpenSSHChannel(object):
+    """
+    paramiko.Channel look-alike, running one 'ssh' client process which is
+    multiplexed over the master connection of its OpenSSHTransport.
+
+    Two reader threads move the process' stdout / stderr into buffers.
+    Like paramiko, fileno() returns a pipe which is readable while buffered
+    data or EOF is pending, so select() based readers work unchanged.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.process = None
+        self.closed = False
+        self.timeout = None
+        self.in_window_size = READ_SIZE
+        self._use_pty = False
+        self._environment = dict()
+        self._cond = threading.Condition()
+        self._buffers = {False: bytearray(), True: bytearray()}
+        self._eof = {False: False, True: False}
+        self._event = make_pipe()
+
+    def __repr__(self):
+        return "<OpenSSHChannel {} pid={}>".format(
+            self.transport.hostname,
+            self.process.pid if self.process else None)
+
+    def get_transport(self):
+        return self.transport
+
+    def get_name(self):
+        return repr(self)
+
+    def get_pty(self, *args, **kwargs):
+        self._use_pty = True
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def update_environment(self, environment):
+        self._environment.update(environment)
+
+    def exec_command(self, command):
+        self.__start(["-tt" if self._use_pty else "-T", "--",
+                      self.transport.hostname, command])
+
+    def invoke_shell(self):
+        self.__start(["-tt", "--", self.transport.hostname])
+
+    def invoke_subsystem(self, subsystem):
+        self.__start(["-T", "-s", "--", self.transport.hostname, subsystem])
+
+    def __start(self, args):
+        if self.process is not None:
+            raise paramiko.SSHException("Channel already in use")
+        options = ["-q"]
+        for key, value in self._environment.items():
+            options += ["-o", "SetEnv={}={}".format(key, value)]
+        self.process = Popen(self.transport.get_command(options + args),
+                             stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                             env=self.transport.env)
+        for stream, is_stderr in ((self.process.stdout, False),
+                                  (self.process.stderr, True)):
+            reader = threading.Thread(target=self.__read_stream,
+                                      args=(stream, is_stderr))
+            reader.daemon = True
+            reader.start()
+
+    def __read_stream(self, stream, is_stderr):
+        fd = stream.fileno()
+        while True:
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError:
+                data = b''
+            with self._cond:
+                if data:
+                    self._buffers[is_stderr] += data
+                else:
+                    self._eof[is_stderr] = True
+                self.__update_event()
+                self._cond.notify_all()
+            if not data:
+                stream.close()
+                break
+
+    def __update_event(self):
+        # Caller must hold self._cond
+        if self.closed:
+            return
+        if self._buffers[False] or self._buffers[True] or self.eof_received:
+            self._event.set()
+        else:
+            self._event.clear()
+
+    def __recv(self, nbytes, is_stderr):
+        end_time = None
+        if self.timeout is not None:
+            end_time = time.time() + self.timeout
+        with self._cond:
+            while not self._buffers[is_stderr] and not self._eof[is_stderr] \
+                    and not self.closed:
+                remaining = None
+                if end_time is not None:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                self._cond.wait(remaining)
+            buffer = self._buffers[is_stderr]
+            data = bytes(buffer[:nbytes])
+            del buffer[:nbytes]
+            self.__update_event()
+            return data
+
+    def recv(self, nbytes):
+        return self.__recv(nbytes, False)
+
+    def recv_stderr(self, nbytes):
+        return self.__recv(nbytes, True)
+
+    def recv_ready(self):
+        with self._cond:
+            return len(self._buffers[False]) > 0
+
+    def recv_stderr_ready(self):
+        with self._cond:
+            return len(self._buffers[True]) > 0
+
+    @property
+    def eof_received(self):
+        return self._eof[False] and self._eof[True]
+
+    def fileno(self):
+        return self._event.fileno()
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (OSError, ValueError) as e:
+            raise socket.error(str(e))
+        return len(data)
+
+    sendall = send
+
+    def shutdown_write(self):
+        if self.process is not None and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def exit_status_ready(self):
+        return self.process is not None and self.process.poll() is not None
+
+    def recv_exit_status(self):
+        status = self.process.wait()
+        # Negative for a local ssh killed by a signal
+        return status if status >= 0 else -1
+
+    def makefile(self, *params):
+        return ChannelFile(self, *params)
+
+    def makefile_stderr(self, *params):
+        return ChannelStderrFile(self, *params)
+
+    def makefile_stdin(self, *params):
+        return ChannelStdinFile(self, *params)
+
+    def close(self):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._event.close()
+            self._cond.notify_all()
+        if self.process is not None:
+            self.shutdown_write()
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(5)
+                except TimeoutExpired:
+                    self.process.kill()
+
+
+class OpenSSHTransport(object):
+    """
+    paramiko.Transport look-alike for a master connection of the 'ssh'
+    binary (ControlMaster). Every session is a short lived 'ssh' process
+    multiplexed over the master's control socket.
+    """
+    def __init__(self, hostname, options, env, control_path,
+                 known_hosts_file):
+        self.hostname = hostname
+        self.options = options
+        self.env = env
+        self.control_path = control_path
+        self.known_hosts_file = known_hosts_file
+        self.closed = False
+
+    def get_command(self, args):
+        command = [OpenSSHClient.ssh_binary] + self.options + args
+        if self.env is not None:
+            command = ["sshpass", "-e"] + command
+        return command
+
+    @property
+    def active(self):
+        return not self.closed and os.path.exists(self.control_path)
+
+    def is_active(self):
+        return self.active
+
+    def is_authenticated(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        # The master sends keepalives itself (ServerAliveInterval)
+        pass
+
+    def send_ignore(self, byte_count=None):
+        """
+        Asks the master process whether it is still running
+        """
+        process = Popen(self.get_command(["-O", "check", "--",
+                                          self.hostname]),
+                        stdout=DEVNULL, stderr=DEVNULL, env=self.env)
+        if process.wait() != 0:
+            raise paramiko.SSHException("SSH master connection is gone")
+
+    def open_session(self, window_size=None, max_packet_size=None,
+                     timeout=None):
+        if not self.active:
+            raise paramiko.SSHException("SSH session not active")
+        return OpenSSHChannel(self)
+
+    def open_sftp_client(self):
+        channel = self.open_session()
+        channel.invoke_subsystem("sftp")
+        return paramiko.SFTPClient(channel)
+
+    def get_remote_server_key(self):
+        with open(self.known_hosts_file) as fp:
+            for line in fp:
+                entry = HostKeyEntry.from_line(line)
+                if entry is not None and entry.key is not None:
+                    return entry.key
+        raise paramiko.SSHException("Host key of {} not known"
+                                    .format(self.hostname))
+
+    def stop_master(self):
+        Popen(self.get_command(["-O", "exit", "--", self.hostname]),
+              stdout=DEVNULL, stderr=DEVNULL, env=self.env).wait()
+
+    def close(self):
+        # The master connection stays up for ControlPersist secs,
+        # so it can be reused by other connections to the same host
+        self.closed = True
+
+
+class OpenSSHClient(paramiko.SSHClient):
+    """
+    SSH client running on top of the system's OpenSSH 'ssh' binary.
+
+    Encryption happens in the native ssh processes instead of under the
+    GIL, and all clients (also across processes) for the same user@host
+    share one ControlMaster connection, kept open for control_persist secs
+    after its last use. exec_command(), invoke_shell() and open_sftp() keep
+    the paramiko.SSHClient interface, so ShellConnection works on it
+    unchanged:
+
+        ShellConnection.ssh_client_class = OpenSSHClient
+
+    Password logins require the 'sshpass' utility.
+    """
+    ssh_binary = "ssh"
+    control_dir = os.path.join(tempfile.gettempdir(),
+                               "ssh_util_{}".format(getpass.getuser()))
+    control_persist = 600
+    server_alive_interval = 30
+    # Additional '-o' options passed to ssh, like ["Ciphers=aes128-ctr"]
+    extra_options = list()
+
+    def get_command_options(self, hostname, port, username, key_filename,
+                            password, timeout, compress,
+                            transport_profile=None):
+        if not os.path.isdir(self.control_dir):
+            os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        host_id = hashlib.sha1("{}@{}:{}".format(username, hostname, port)
+                               .encode()).hexdigest()[:16]
+        control_path = os.path.join(self.control_dir,
+                                    "{}.sock".format(host_id))
+        known_hosts_file = os.path.join(self.control_dir,
+                                        "{}.known_hosts".format(host_id))
+        options = ["-p", str(port),
+                   "-o", "ControlMaster=auto",
+                   "-o", "ControlPath={}".format(control_path),
+                   "-o", "ControlPersist={}".format(self.control_persist),
+                   "-o", "ServerAliveInterval={}"
+                         .format(self.server_alive_interval),
+                   "-o", "ServerAliveCountMax=3",
+                   # Same as paramiko.AutoAddPolicy. The file only holds
+                   # the key of the current master connection.
+                   "-o", "StrictHostKeyChecking=no",
+                   "-o", "UserKnownHostsFile={}".format(known_hosts_file),
+                   "-o", "GlobalKnownHostsFile=/dev/null",
+                   "-o", "UpdateHostKeys=no",
+                   "-o", "HashKnownHosts=no",
+                   "-o", "LogLevel=ERROR"]
+        if username:
+            options += ["-l", username]
+        if timeout:
+            options += ["-o", "ConnectTimeout={}".format(int(timeout))]
+        if compress:
+            options.append("-C")
+        if key_filename:
+            options += ["-i", key_filename, "-o", "IdentitiesOnly=yes",
+                        "-o", "BatchMode=yes"]
+        elif password:
+            options += ["-o", "PubkeyAuthentication=no",
+                        "-o", "NumberOfPasswordPrompts=1"]
+        else:
+            options += ["-o", "BatchMode=yes"]
+        if transport_profile is not None:
+            for option in transport_profile.get_ssh_options():
+                options += ["-o", option]
+        for option in self.extra_options:
+            options += ["-o", option]
+        return options, control_path, known_hosts_file
+
+    def connect(self, hostname, port=22, username=None, password=None,
+                key_filename=None, timeout=None, compress=False,
+                banner_timeout=None, auth_timeout=None, transport_profile=None,
+                **kwargs):
+        """
+        Starts (or attaches to) the master connection for user@hostname.
+        Raises the same kind of errors as paramiko.SSHClient.connect()
+        :param transport_profile: TransportProfile for the master connection.
+                                  Only applied when a new master is started
+        """
+        if isinstance(key_filename, (list, tuple)):
+            key_filename = key_filename[0] if key_filename else None
+        env = None
+        if password and not key_filename:
+            if shutil.which("sshpass") is None:
+                raise paramiko.AuthenticationException(
+                    "sshpass is required for password logins using {}"
+                    .format(self.__class__.__name__))
+            env = dict(os.environ, SSHPASS=password)
+        options, control_path, known_hosts_file = self.get_command_options(
+            hostname, port, username, key_filename, password, timeout,
+            compress, transport_profile)
+        transport = OpenSSHTransport(hostname, options, env, control_path,
+                                     known_hosts_file)
+        if not os.path.exists(control_path) \
+                and os.path.exists(known_hosts_file):
+            # Host might have been reinstalled since the last master
+            os.remove(known_hosts_file)
+
+        wait_time = sum([t for t in (timeout, banner_timeout, auth_timeout)
+                         if t]) or None
+        with tempfile.TemporaryFile() as stderr:
+            # stderr goes to a file, since the backgrounded master process
+            # may keep the inherited descriptor open
+            process = Popen(transport.get_command(["-T", "--", hostname,
+                                                   "exit 0"]),
+                            stdin=DEVNULL, stdout=DEVNULL, stderr=stderr,
+                            env=env)
+            try:
+                status = process.wait(wait_time)
+            except TimeoutExpired:
+                process.kill()
+                process.wait()
+                raise socket.timeout("Timed out connecting to {}"
+                                     .format(hostname))
+            stderr.seek(0)
+            error = stderr.read().decode(errors='replace').strip()
+
+        if status != 0:
+            if "Permission denied" in error \
+                    or "Too many authentication failures" in error:
+                raise paramiko.AuthenticationException(error)
+            if "timed out" in error:
+                raise socket.timeout(error)
+            raise ConnectionError("ssh exited with {}: {}"
+                                  .format(status, error))
+        self._transport = transport
@@ -1,4 +1,5 @@
 from shell_util.platforms.constants import LinuxConstants
+from shell_util.remote_config_file import RemoteConfigFile
 from shell_util.shell_conn import ShellConnection
 
 
@@ -252,39 +253,14 @@ class Linux(ShellConnection, LinuxConstants):
     def change_log_level(self, new_log_level):
         self.log.info("CHANGE LOG LEVEL TO %s".format(new_log_level))
         # ADD NON_ROOT user config_details
-        output, error = self.execute_command("sed -i '/loglevel_default, /c \\{loglevel_default, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_ns_server, /c \\{loglevel_ns_server, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_stats, /c \\{loglevel_stats, %s\}'. %s"
-                                             % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_rebalance, /c \\{loglevel_rebalance, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_cluster, /c \\{loglevel_cluster, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_views, /c \\{loglevel_views, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_error_logger, /c \\{loglevel_error_logger, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_mapreduce_errors, /c \\{loglevel_mapreduce_errors, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_user, /c \\{loglevel_user, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_xdcr, /c \\{loglevel_xdcr, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/loglevel_menelaus, /c \\{loglevel_menelaus, %s\}'. %s"
-                                            % (new_log_level, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
+        with RemoteConfigFile(self, testconstants.LINUX_STATIC_CONFIG) \
+                as static_config:
+            for log_name in ["default", "ns_server", "stats", "rebalance",
+                             "cluster", "views", "error_logger",
+                             "mapreduce_errors", "user", "xdcr", "menelaus"]:
+                static_config.replace_lines(
+                    "loglevel_%s, " % log_name,
+                    "{loglevel_%s, %s}." % (log_name, new_log_level))
 
     def configure_log_location(self, new_log_location):
         mv_logs = testconstants.LINUX_LOG_PATH + '/' + new_log_location
@@ -292,49 +268,39 @@ class Linux(ShellConnection, LinuxConstants):
         error_log_tag = "error_logger_mf_dir"
         # ADD NON_ROOT user config_details
         self.log.info("CHANGE LOG LOCATION TO %s".format(mv_logs))
-        output, error = self.execute_command("rm -rf %s" % mv_logs)
-        self.log_command_output(output, error)
-        output, error = self.execute_command("mkdir %s" % mv_logs)
-        self.log_command_output(output, error)
-        output, error = self.execute_command("chown -R couchbase %s" % mv_logs)
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/%s, /c \\{%s, \"%s\"\}.' %s"
-                                             % (error_log_tag, error_log_tag, mv_logs, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
+        commands = ["rm -rf %s" % mv_logs,
+                    "mkdir %s" % mv_logs,
+                    "chown -R couchbase %s" % mv_logs,
+                    "sed -i '/%s, /c \\{%s, \"%s\"\}.' %s"
+                    % (error_log_tag, error_log_tag, mv_logs, testconstants.LINUX_STATIC_CONFIG)]
+        for output, error, _ in self.execute_commands_batch(commands):
+            self.log_command_output(output, error)
 
     def change_stat_periodicity(self, ticks):
         # ADD NON_ROOT user config_details
         self.log.info("CHANGE STAT PERIODICITY TO every %s seconds" % ticks)
-        output, error = self.execute_command("sed -i '$ a\{grab_stats_every_n_ticks, %s}.'  %s"
-                                             % (ticks, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
+        with RemoteConfigFile(self, testconstants.LINUX_STATIC_CONFIG) \
+                as static_config:
+            static_config.append_line("{grab_stats_every_n_ticks, %s}."
+                                      % ticks)
 
     def change_port_static(self, new_port):
         # ADD NON_ROOT user config_details
         self.log.info("=========CHANGE PORTS for REST: %s, MCCOUCH: %s,MEMCACHED: %s, CAPI: %s==============="
                       % (new_port, new_port + 1, new_port + 2, new_port + 4))
-        output, error = self.execute_command("sed -i '/{rest_port/d' %s" % testconstants.LINUX_STATIC_CONFIG)
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '$ a\{rest_port, %s}.' %s"
-                                             % (new_port, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/{mccouch_port/d' %s" % testconstants.LINUX_STATIC_CONFIG)
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '$ a\{mccouch_port, %s}.' %s"
-                                             % (new_port + 1, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/{memcached_port/d' %s" % testconstants.LINUX_STATIC_CONFIG)
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '$ a\{memcached_port, %s}.' %s"
-                                             % (new_port + 2, testconstants.LINUX_STATIC_CONFIG))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("sed -i '/port = /c\port = %s' %s"
-                                             % (new_port + 4, testconstants.LINUX_CAPI_INI))
-        self.log_command_output(output, error)
-        output, error = self.execute_command("rm %s" % testconstants.LINUX_CONFIG_FILE)
-        self.log_command_output(output, error)
-        output, error = self.execute_command("cat %s" % testconstants.LINUX_STATIC_CONFIG)
+        with RemoteConfigFile(self, testconstants.LINUX_STATIC_CONFIG) \
+                as static_config:
+            for index, port_name in enumerate(["rest_port", "mccouch_port",
+                                               "memcached_port"]):
+                static_config.delete_lines("{%s" % port_name)
+                static_config.append_line("{%s, %s}."
+                                          % (port_name, new_port + index))
+        with RemoteConfigFile(self, testconstants.LINUX_CAPI_INI) as capi_ini:
+            capi_ini.replace_lines("port = ", "port = %s" % (new_port + 4))
+        output, error = self.execute_command(
+            "rm %s" % testconstants.LINUX_CONFIG_FILE)
         self.log_command_output(output, error)
+        self.log_command_output(static_config.lines, [])
 
     def disable_firewall(self):
         command_1 = "/sbin/iptables -F"
@@ -421,38 +387,31 @@ class Linux(ShellConnection, LinuxConstants):
         shell.close()
 
     def change_env_variables(self, dict):
-        prefix = "\\n    "
-        shell = self._ssh_client.invoke_shell()
+        prefix = "\n    "
         init_file = "couchbase-server"
         file_path = "/opt/couchbase/bin/"
         environmentVariables = ""
-        backupfile = file_path + init_file + ".bak"
         sourceFile = file_path + init_file
-        o, r = self.execute_command("cp " + sourceFile + " " + backupfile)
-        self.log_command_output(o, r)
-        command = "sed -i 's/{0}/{0}".format("ulimit -l unlimited")
-        for key in list(dict.keys()):
-            o, r = self.execute_command(
-                "sed -i 's/{1}.*//' {0}".format(sourceFile, key))
-            self.log_command_output(o, r)
-            o, r = self.execute_command(
-                "sed -i 's/export ERL_FULLSWEEP_AFTER/export "
-                "ERL_FULLSWEEP_AFTER\\n{1}={2}\\nexport {1}/' {0}"
-                .format(sourceFile, key, dict[key]))
-            self.log_command_output(o, r)
-
-        for key in list(dict.keys()):
-            environmentVariables += prefix \
-                 + 'export {0}={1}'.format(key, dict[key])
-
-        command += environmentVariables + "/'" + " " + sourceFile
-        o, r = self.execute_command(command)
-        self.log_command_output(o, r)
+        # Original is kept as couchbase-server.bak for reset_env_variables()
+        with RemoteConfigFile(self, sourceFile, backup=True) as init_script:
+            for key in list(dict.keys()):
+                init_script.substitute("{0}.*".format(key), "")
+                init_script.substitute(
+                    "export ERL_FULLSWEEP_AFTER",
+                    "export ERL_FULLSWEEP_AFTER\n{0}={1}\nexport {0}"
+                    .format(key, dict[key]))
+
+            for key in list(dict.keys()):
+                environmentVariables += prefix \
+                     + 'export {0}={1}'.format(key, dict[key])
+
+            init_script.substitute("ulimit -l unlimited",
+                                   "ulimit -l unlimited"
+                                   + environmentVariables)
 
         # Restart Couchbase
         o, r = self.execute_command("service couchbase-server restart")
         self.log_command_output(o, r)
-        shell.close()
 
     def reset_env_variables(self):
         shell = self._ssh_client.invoke_shell()
@@ -478,30 +437,21 @@ class Linux(ShellConnection, LinuxConstants):
         :param size: Size of the partition in MB
         :return: Nothing
         """
-        command = "umount -l {0}".format(location)
-        output, error = self.execute_command(command)
-        command = "rm -rf {0}".format(location)
-        output, error = self.execute_command(command)
-        command = "rm -rf /usr/disk-img/disk-quota.ext3"
-        output, error = self.execute_command(command)
-        command = "mkdir -p {0}".format(location)
-        output, error = self.execute_command(command)
         if size:
             count = (size * 1024 * 1024) // 512
         else:
             count = (5 * 1024 * 1024 * 1024) // 512
-        command = "mkdir -p /usr/disk-img"
-        output, error = self.execute_command(command)
-        command = "dd if=/dev/zero of=/usr/disk-img/disk-quota.ext3 count={0}".format(count)
-        output, error = self.execute_command(command)
-        command = "/sbin/mkfs -t ext3 -q /usr/disk-img/disk-quota.ext3 -F"
-        output, error = self.execute_command(command)
-        command = "mount -o loop,rw,usrquota,grpquota /usr/disk-img/disk-quota.ext3 {0}".format(location)
-        output, error = self.execute_command(command)
-        command = "chown 'couchbase' {0}".format(location)
-        output, error = self.execute_command(command)
-        command = "chmod 777 {0}".format(location)
-        output, error = self.execute_command(command)
+        commands = ["umount -l {0}".format(location),
+                    "rm -rf {0}".format(location),
+                    "rm -rf /usr/disk-img/disk-quota.ext3",
+                    "mkdir -p {0}".format(location),
+                    "mkdir -p /usr/disk-img",
+                    "dd if=/dev/zero of=/usr/disk-img/disk-quota.ext3 count={0}".format(count),
+                    "/sbin/mkfs -t ext3 -q /usr/disk-img/disk-quota.ext3 -F",
+                    "mount -o loop,rw,usrquota,grpquota /usr/disk-img/disk-quota.ext3 {0}".format(location),
+                    "chown 'couchbase' {0}".format(location),
+                    "chmod 777 {0}".format(location)]
+        self.execute_commands_batch(commands)
 
     def mount_partition(self, location):
         """
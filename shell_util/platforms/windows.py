@@ -295,7 +295,7 @@ class Windows(ShellConnection, WindowsConstants):
         if not(query == ""):
             main_command = main_command + " -s=\"" + query+ '"'
         elif (self.remote and not(queries == "")):
-            sftp = self._ssh_client.open_sftp()
+            sftp = self.get_sftp_client()
             filein = sftp.open(filename, 'w')
             for query in queries:
                 filein.write(query)
@@ -374,7 +374,6 @@ class Windows(ShellConnection, WindowsConstants):
             time.sleep(1)
         if (self.remote and not(queries=="")) :
             sftp.remove(filename)
-            sftp.close()
         elif not(queries==""):
             os.remove(filename)
 
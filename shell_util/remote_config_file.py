@@ -0,0 +1,205 @@
+import logging
+import os
+import re
+import shutil
+import uuid
+
+log = logging.getLogger("shell_util")
+
+
+class RemoteConfigFile(object):
+    """
+    Text file on the node of a ShellConnection, edited in memory.
+
+    The file is fetched once over SFTP, all edits are applied to the lines
+    held in memory and the result is written back to a temp file next to
+    the original, which is then renamed over it. So N edits cost two file
+    transfers instead of one 'sed -i' process per edit, and readers of the
+    file never see it half written.
+    The edit methods follow the semantics of the sed commands they replace.
+    For connections to localhost the file is edited directly.
+
+    Usage:
+        with RemoteConfigFile(shell, path) as config:
+            config.delete_lines("{rest_port")
+            config.append_line("{rest_port, 9000}.")
+    """
+    backup_suffix = ".bak"
+
+    def __init__(self, shell, file_path, backup=False):
+        """
+        :param shell: ShellConnection object of the node
+        :param file_path: Path of the file on the node
+        :param backup: If True, the original content is saved to
+                       file_path + backup_suffix before it gets replaced
+        """
+        self.shell = shell
+        self.file_path = file_path
+        self.backup = backup
+        self.lines = None
+        self.trailing_newline = True
+        self.original_data = None
+        self.stat = None
+        self.modified = False
+
+    def __enter__(self):
+        self.load()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.save()
+
+    def load(self):
+        """
+        Fetch the file from the node, dropping any unsaved edits
+        :return: List of lines of the file, without line endings
+        """
+        if self.shell.remote:
+            sftp = self.shell.get_sftp_client()
+            with sftp.open(self.file_path, "rb") as fp:
+                self.stat = fp.stat()
+                fp.prefetch()
+                self.original_data = fp.read()
+        else:
+            with open(self.file_path, "rb") as fp:
+                self.stat = os.fstat(fp.fileno())
+                self.original_data = fp.read()
+        content = self.original_data.decode("utf-8", "surrogateescape")
+        self.__set_content(content)
+        self.modified = False
+        return self.lines
+
+    def __set_content(self, content):
+        self.lines = content.split("\n")
+        self.trailing_newline = (self.lines[-1] == "")
+        if self.trailing_newline:
+            self.lines.pop()
+
+    def get_content(self):
+        content = "\n".join(self.lines)
+        if self.lines and self.trailing_newline:
+            content += "\n"
+        return content
+
+    def replace_lines(self, pattern, new_line):
+        """
+        Replace every line matching the regex, like sed '/pattern/c\\line'
+        :return: Number of replaced lines
+        """
+        regex = re.compile(pattern)
+        count = 0
+        for index, line in enumerate(self.lines):
+            if regex.search(line):
+                self.lines[index] = new_line
+                count += 1
+        self.modified = self.modified or count > 0
+        return count
+
+    def delete_lines(self, pattern):
+        """
+        Delete every line matching the regex, like sed '/pattern/d'
+        :return: Number of deleted lines
+        """
+        regex = re.compile(pattern)
+        lines = [line for line in self.lines if not regex.search(line)]
+        count = len(self.lines) - len(lines)
+        self.lines = lines
+        self.modified = self.modified or count > 0
+        return count
+
+    def append_line(self, line):
+        """
+        Append a line at the end of the file, like sed '$ a\\line'
+        """
+        self.lines.append(line)
+        self.trailing_newline = True
+        self.modified = True
+
+    def substitute(self, pattern, repl):
+        """
+        Replace the first match of the regex in every line, like
+        sed 's/pattern/repl/'. 'repl' is a re.sub() replacement, so it may
+        refer to groups and may contain newlines, which split the line.
+        :return: Number of changed lines
+        """
+        regex = re.compile(pattern)
+        count = 0
+        for index, line in enumerate(self.lines):
+            new_line, n = regex.subn(repl, line, count=1)
+            if n:
+                self.lines[index] = new_line
+                count += 1
+        if count:
+            self.__set_content(self.get_content())
+            self.modified = True
+        return count
+
+    def save(self):
+        """
+        Write the edited content back to the node, if anything changed.
+        Mode and ownership of the original file are kept.
+        :return: True if the file got written
+        """
+        if not self.modified:
+            return False
+        data = self.get_content().encode("utf-8", "surrogateescape")
+        tmp_path = "{}.{}.tmp".format(self.file_path, uuid.uuid4().hex)
+        if self.shell.remote:
+            self.__save_remote(data, tmp_path)
+        else:
+            self.__save_local(data, tmp_path)
+        log.debug("{} - Wrote {} ({} lines)"
+                  .format(self.shell.ip, self.file_path, len(self.lines)))
+        self.original_data = data
+        self.modified = False
+        return True
+
+    def __save_remote(self, data, tmp_path):
+        sftp = self.shell.get_sftp_client()
+        try:
+            if self.backup:
+                self.__write_remote(sftp, self.file_path + self.backup_suffix,
+                                    self.original_data)
+            self.__write_remote(sftp, tmp_path, data)
+            try:
+                sftp.posix_rename(tmp_path, self.file_path)
+            except IOError:
+                # Server without the posix-rename extension
+                sftp.remove(self.file_path)
+                sftp.rename(tmp_path, self.file_path)
+        except Exception:
+            try:
+                sftp.remove(tmp_path)
+            except IOError:
+                pass
+            raise
+
+    def __write_remote(self, sftp, path, data):
+        with sftp.open(path, "wb") as fp:
+            fp.set_pipelined(True)
+            fp.write(data)
+        sftp.chmod(path, self.stat.st_mode & 0o7777)
+        try:
+            sftp.chown(path, self.stat.st_uid, self.stat.st_gid)
+        except IOError:
+            # Not allowed for non-root users, file stays owned by them
+            pass
+
+    def __save_local(self, data, tmp_path):
+        try:
+            if self.backup:
+                shutil.copy2(self.file_path,
+                             self.file_path + self.backup_suffix)
+            with open(tmp_path, "wb") as fp:
+                fp.write(data)
+            os.chmod(tmp_path, self.stat.st_mode & 0o7777)
+            try:
+                os.chown(tmp_path, self.stat.st_uid, self.stat.st_gid)
+            except OSError:
+                pass
+            os.replace(tmp_path, self.file_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -1,3 +1,4 @@
+from shell_util.info_cache import RemoteMachineInfoCache
 from shell_util.platforms.linux import Linux
 from shell_util.platforms.unix import Unix
 from shell_util.platforms.windows import Windows
@@ -12,6 +13,26 @@ class SupportedPlatforms(object):
 
 class RemoteMachineShellConnection(object):
     __info_dict = dict()
+    # Optional on-disk cache, enabled using enable_info_cache()
+    info_cache = None
+
+    @staticmethod
+    def enable_info_cache(cache_dir=None, ttl=86400):
+        """
+        Persist the RemoteMachineInfo of the nodes across runs, so the
+        remote machine probing is skipped for known hosts.
+        :param cache_dir: Directory to store the cache files.
+                          Defaults to ~/.cache/ssh_util/remote_info
+        :param ttl: Secs after which a cached entry is probed again
+        :return: RemoteMachineInfoCache object
+        """
+        RemoteMachineShellConnection.info_cache = \
+            RemoteMachineInfoCache(cache_dir, ttl)
+        return RemoteMachineShellConnection.info_cache
+
+    @staticmethod
+    def disable_info_cache():
+        RemoteMachineShellConnection.info_cache = None
 
     @staticmethod
     def get_info_for_server(server):
@@ -20,16 +41,56 @@ class RemoteMachineShellConnection(object):
 
     def __new__(cls, *args, **kwargs):
         server = args[0]
+        # Optional TransportProfile for the connection
+        transport_profile = kwargs.pop("transport_profile", None)
+        shell = None
         if server.ip in RemoteMachineShellConnection.__info_dict:
             info = RemoteMachineShellConnection.__info_dict[server.ip]
         else:
             shell = ShellConnection(server)
-            shell.ssh_connect_with_retries(server.ip, server.ssh_username,
-                                           server.ssh_password, server.ssh_key)
-            info = shell.extract_remote_info()
+            if transport_profile is not None:
+                shell.transport_profile = transport_profile
+        try:
+            if shell is not None:
+                info = cls.__probe_remote_info(shell, server)
+            obj = cls.__new_platform_object(info, *args, **kwargs)
+            obj.__init__(server, info)
+            if transport_profile is not None:
+                obj.transport_profile = transport_profile
+            if shell is not None:
+                # Reuse the session opened for probing the remote machine
+                # instead of doing a second handshake for the platform object
+                obj.adopt_connection(shell)
+        except Exception:
+            if shell is not None:
+                shell.disconnect()
+            raise
+        if shell is not None:
+            # Only counts the disconnection, the session moved to obj
             shell.disconnect()
-            RemoteMachineShellConnection.__info_dict[server.ip] = info
+        else:
+            obj.ssh_connect_with_retries(server.ip, server.ssh_username,
+                                         server.ssh_password, server.ssh_key)
+        return obj
 
+    @staticmethod
+    def __probe_remote_info(shell, server):
+        shell.ssh_connect_with_retries(server.ip, server.ssh_username,
+                                       server.ssh_password, server.ssh_key)
+        info = None
+        info_cache = RemoteMachineShellConnection.info_cache
+        if info_cache is not None:
+            fingerprint = shell.get_host_key_fingerprint()
+            info = info_cache.get(server.ip, fingerprint)
+        if info is None:
+            info = shell.extract_remote_info()
+            if info_cache is not None:
+                info_cache.put(server.ip, fingerprint, info)
+        RemoteMachineShellConnection.__info_dict[server.ip] = info
+        return info
+
+    @classmethod
+    def __new_platform_object(cls, info, *args, **kwargs):
         platform = info.type.lower()
         if platform == SupportedPlatforms.LINUX:
             target_class = Linux
@@ -39,12 +100,8 @@ class RemoteMachineShellConnection(object):
             target_class = Unix
         else:
             raise NotImplementedError("Unsupported platform")
-        obj = super(RemoteMachineShellConnection, cls) \
+        return super(RemoteMachineShellConnection, cls) \
             .__new__(target_class, *args, **kwargs)
-        obj.__init__(server, info)
-        obj.ssh_connect_with_retries(server.ip, server.ssh_username,
-                                     server.ssh_password, server.ssh_key)
-        return obj
 
     @staticmethod
     def delete_info_for_server(server, ipaddr=None):
@@ -52,3 +109,5 @@ class RemoteMachineShellConnection(object):
         if ipaddr in RemoteMachineShellConnection.__info_dict:
             del RemoteMachineShellConnection.__info_dict[ipaddr]
         RemoteMachineShellConnection.__info_dict.pop(ipaddr, None)
+        if RemoteMachineShellConnection.info_cache is not None:
+            RemoteMachineShellConnection.info_cache.delete(ipaddr)
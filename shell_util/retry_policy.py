@@ -0,0 +1,95 @@
+import random
+import socket
+import time
+
+import paramiko
+
+
+class RetryPolicy(object):
+    """
+    Timeouts and retry behavior used while establishing SSH connections.
+
+    Backoff uses 'full jitter': the delay before attempt N+1 is a random
+    value between 0 and min(max_delay, base_delay * 2^(N-1)), so parallel
+    reconnects towards the same hosts don't line up.
+    """
+    def __init__(self, max_attempts=5, base_delay=10, max_delay=120,
+                 deadline=300, connect_timeout=10, banner_timeout=30,
+                 auth_timeout=30):
+        """
+        :param max_attempts: Max. number of connection attempts
+        :param base_delay: Upper bound of the first backoff delay in secs
+        :param max_delay: Cap of the backoff delay in secs
+        :param deadline: Max. secs spent on all attempts. None for no limit
+        :param connect_timeout: TCP connect timeout per attempt
+        :param banner_timeout: Timeout waiting for the SSH banner
+        :param auth_timeout: Timeout waiting for the auth response
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.banner_timeout = banner_timeout
+        self.auth_timeout = auth_timeout
+
+    def __repr__(self):
+        return "RetryPolicy({})".format(
+            ", ".join(["{}={}".format(k, v)
+                       for k, v in sorted(self.__dict__.items())]))
+
+    def copy(self, **overrides):
+        policy = RetryPolicy()
+        policy.__dict__.update(self.__dict__)
+        policy.__dict__.update(overrides)
+        return policy
+
+    def get_remaining(self, start_time):
+        """
+        :return: Secs left before the deadline or None if there is none
+        """
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - (time.time() - start_time))
+
+    def get_backoff(self, attempt):
+        """
+        :param attempt: Number of the attempt which just failed (1 based)
+        :return: Secs to sleep before the next attempt
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def get_connect_kwargs(self, start_time):
+        """
+        Timeouts for paramiko.SSHClient.connect(), never running past
+        the deadline
+        """
+        timeouts = {"timeout": self.connect_timeout,
+                    "banner_timeout": self.banner_timeout,
+                    "auth_timeout": self.auth_timeout}
+        remaining = self.get_remaining(start_time)
+        if remaining is not None:
+            for key, value in timeouts.items():
+                timeouts[key] = max(1, min(value, remaining))
+        return timeouts
+
+    @staticmethod
+    def is_fatal(error):
+        """
+        Tells whether retrying can help for the given connect() error.
+        Authentication / host key / local key file problems won't go away
+        with a retry, while network level errors may.
+        """
+        if isinstance(error, (paramiko.AuthenticationException,
+                              paramiko.BadHostKeyException,
+                              paramiko.PasswordRequiredException)):
+            return True
+        if isinstance(error, (paramiko.ssh_exception.NoValidConnectionsError,
+                              socket.timeout, socket.gaierror,
+                              ConnectionError, EOFError)):
+            return False
+        if isinstance(error, (FileNotFoundError, PermissionError)):
+            # Missing / unreadable local key_filename
+            return True
+        return False
@@ -0,0 +1,122 @@
+import threading
+
+import paramiko
+from paramiko.common import DEBUG
+from paramiko.message import Message
+from paramiko.sftp import CMD_STATUS
+
+
+class SharedSFTPClient(paramiko.SFTPClient):
+    """
+    paramiko.SFTPClient which can be used by several threads at a time.
+
+    paramiko sends requests and reads responses outside of its lock, so
+    threads sharing a client interleave their packets on the channel, or
+    consume (and drop) each other's responses, leaving the requesting
+    thread waiting forever. Here packets are sent one at a time, only one
+    thread at a time reads from the channel and responses it reads for
+    requests of other threads are handed over to them.
+    Responses a thread skips while waiting for one of its own requests are
+    dropped, the same way paramiko does it for a single thread.
+    """
+    def __init__(self, sock):
+        self.__send_lock = threading.Lock()
+        self.__cond = threading.Condition()
+        self.__reading = False
+        # Sequence number of the last response read from the channel
+        self.__seq = 0
+        # Request number -> id of the thread which sent it, for requests
+        # without a file object (synchronous calls, pipelined writes)
+        self.__owners = dict()
+        # Request number -> (seq, owner, type, msg) of responses read by
+        # another thread than the one which sent the request
+        self.__responses = dict()
+        super(SharedSFTPClient, self).__init__(sock)
+
+    def _send_packet(self, t, packet):
+        with self.__send_lock:
+            super(SharedSFTPClient, self)._send_packet(t, packet)
+
+    def _async_request(self, fileobj, t, *args):
+        num = super(SharedSFTPClient, self)._async_request(fileobj, t, *args)
+        if fileobj is type(None):
+            owner = threading.get_ident()
+            with self.__cond:
+                if num in self.__responses:
+                    # Response arrived before the owner got recorded
+                    seq, _, r_type, msg = self.__responses[num]
+                    self.__responses[num] = (seq, owner, r_type, msg)
+                else:
+                    self.__owners[num] = owner
+        return num
+
+    def __drop_skipped(self, owner, seq):
+        """
+        Drop the handed over responses of the thread which arrived before
+        the one it waited for, paramiko would have skipped them
+        """
+        for num, response in list(self.__responses.items()):
+            if response[1] == owner and response[0] < seq:
+                del self.__responses[num]
+
+    def __read_one(self, waitfor):
+        """
+        Read one response from the channel
+        :return: (type, msg) if it is the one for 'waitfor', else None
+        """
+        try:
+            t, data = self._read_packet()
+        except EOFError as e:
+            raise paramiko.SSHException(
+                "Server connection dropped: {}".format(e))
+        msg = Message(data)
+        num = msg.get_int()
+        with self._lock:
+            fileobj = self._expecting.pop(num, None)
+        ident = threading.get_ident()
+        with self.__cond:
+            self.__seq += 1
+            owner = self.__owners.pop(num, None)
+            if fileobj is None:
+                # Response for a file that was closed before it came back
+                self._log(DEBUG, "Unexpected response #{}".format(num))
+                return None
+            if num == waitfor:
+                self.__drop_skipped(ident, self.__seq)
+                return t, msg
+            if fileobj is type(None):
+                if owner != ident:
+                    self.__responses[num] = (self.__seq, owner, t, msg)
+                return None
+        # Prefetched data or the status of an asynchronous request
+        fileobj._async_response(t, msg, num)
+        return None
+
+    def _read_response(self, waitfor=None):
+        while True:
+            with self.__cond:
+                if waitfor is not None and waitfor in self.__responses:
+                    seq, owner, t, msg = self.__responses.pop(waitfor)
+                    self.__drop_skipped(owner, seq)
+                    break
+                if self.__reading:
+                    # Another thread reads, it hands our response over
+                    self.__cond.wait()
+                    if waitfor is None:
+                        return None, None
+                    continue
+                self.__reading = True
+            try:
+                result = self.__read_one(waitfor)
+            finally:
+                with self.__cond:
+                    self.__reading = False
+                    self.__cond.notify_all()
+            if result is not None:
+                t, msg = result
+                break
+            if waitfor is None:
+                return None, None
+        if t == CMD_STATUS:
+            self._convert_status(msg)
+        return t, msg
@@ -0,0 +1,483 @@
+import hashlib
+import logging
+import mmap
+import os
+import re
+import shlex
+import stat
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("shell_util")
+
+# Prints the sha256 digest of each of the first {num_chunks} chunks of
+# the file, one per line. sha256sum is missing on macOS, shasum isn't
+REMOTE_CHUNK_DIGESTS_SCRIPT = """
+h() {{ sha256sum 2>/dev/null || shasum -a 256; }}
+f={path}; i=0
+while [ $i -lt {num_chunks} ]; do
+    dd if="$f" bs={chunk_size} skip=$i count=1 2>/dev/null | h
+    i=$((i + 1))
+done
+"""
+REMOTE_DIGEST_SCRIPT = """
+h() {{ sha256sum 2>/dev/null || shasum -a 256; }}
+h < {path}
+"""
+
+
+def get_remote_file_path(sftp, src_path, des_path):
+    """
+    :return: des_path, or the path of src_path's file name inside of it
+             if des_path is a directory on the remote side
+    """
+    try:
+        if stat.S_ISDIR(sftp.stat(des_path).st_mode):
+            return "{}/{}".format(des_path.rstrip("/"),
+                                  os.path.basename(src_path))
+    except IOError:
+        pass
+    return des_path
+
+
+class LocalDigestCache(object):
+    """
+    Process wide cache of sha256 digests of local files, keyed by path,
+    size and mtime. Copying the same build to many nodes hashes it once.
+    """
+    __lock = threading.Lock()
+    __digests = dict()
+
+    @classmethod
+    def get(cls, path):
+        """
+        :return: sha256 hex digest of the local file
+        """
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        # Held while hashing, so parallel callers wait for the first one
+        with cls.__lock:
+            if key not in cls.__digests:
+                digest = hashlib.sha256()
+                with open(path, "rb") as fp:
+                    for data in iter(lambda: fp.read(1024 * 1024), b""):
+                        digest.update(data)
+                cls.__digests[key] = digest.hexdigest()
+            return cls.__digests[key]
+
+
+def clear_exception_frames(error):
+    """
+    Drop the local variables of the finished frames in the tracebacks of
+    error and of the exceptions it was raised from
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        traceback.clear_frames(error.__traceback__)
+        error = error.__cause__ or error.__context__
+
+
+def rename_remote_file(sftp, old_path, new_path):
+    try:
+        sftp.posix_rename(old_path, new_path)
+    except IOError:
+        # Server without the posix-rename extension
+        try:
+            sftp.remove(new_path)
+        except IOError:
+            pass
+        sftp.rename(old_path, new_path)
+
+
+class TransferProgress(object):
+    """
+    Thread safe byte counter of a file transfer, reporting to an optional
+    callback(transferred_bytes, total_bytes, bytes_per_sec)
+    """
+    def __init__(self, total, callback=None, transferred=0):
+        self.total = total
+        self.callback = callback
+        self.transferred = transferred
+        self.start_time = time.time()
+        # Bytes already present when the transfer (re)started
+        self.start_offset = transferred
+        self.__lock = threading.Lock()
+
+    def get_rate(self):
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0
+        return (self.transferred - self.start_offset) / elapsed
+
+    def update(self, num_bytes):
+        with self.__lock:
+            self.transferred += num_bytes
+            if self.callback is not None:
+                self.callback(self.transferred, self.total, self.get_rate())
+
+    def get_sftp_callback(self):
+        """
+        :return: Callback for sftp.put() / get(), None without a callback
+        """
+        if self.callback is None:
+            return None
+
+        def sftp_callback(transferred, total):
+            self.update(transferred - self.transferred)
+        return sftp_callback
+
+
+class ParallelUploader(object):
+    """
+    Upload of a local file split into ranges, which are written concurrently
+    through several SFTP sessions of a ShellConnection.
+
+    Every session is a channel with its own flow control window, so on a
+    high latency link N sessions keep about N times as much data in flight
+    as a single sftp.put(). Writes are pipelined (not waiting for each
+    server ack) and the local file is memory mapped, so ranges are sent
+    without copying them into Python buffers first.
+    The extra sessions take one of the connection's session slots each and
+    are only opened as long as free slots are available.
+    """
+    # Files smaller than this are sent with a plain sftp.put()
+    min_size = 32 * 1024 * 1024
+    chunk_size = 8 * 1024 * 1024
+    max_workers = 4
+
+    def __init__(self, shell, callback=None, max_workers=None,
+                 chunk_size=None):
+        """
+        :param shell: Connected ShellConnection object
+        :param callback: Optional progress callback, called with
+                         (transferred_bytes, total_bytes, bytes_per_sec)
+        :param max_workers: Max. number of concurrent SFTP sessions
+        :param chunk_size: Size of the ranges in bytes
+        """
+        self.shell = shell
+        self.callback = callback
+        self.max_workers = max_workers or self.max_workers
+        self.chunk_size = chunk_size or self.chunk_size
+        self.__failed = threading.Event()
+
+    def __open_sftp_clients(self, num_chunks):
+        """
+        :return: List of SFTPClient objects, the connection's cached client
+                 first, and the number of session slots taken for the others
+        """
+        sftp_clients = [self.shell.get_sftp_client()]
+        slots = 0
+        while len(sftp_clients) < min(self.max_workers, num_chunks):
+            if not self.shell._session_slots.acquire(blocking=False):
+                break
+            slots += 1
+            try:
+                sftp_clients.append(self.shell._ssh_client.open_sftp())
+            except Exception as e:
+                log.debug("{} - Unable to open another SFTP session: {}"
+                          .format(self.shell.ip, e))
+                break
+        return sftp_clients, slots
+
+    def __upload_ranges(self, sftp, des_path, data, ranges, progress):
+        with sftp.open(des_path, "r+b", bufsize=0) as fp:
+            fp.set_pipelined(True)
+            while not self.__failed.is_set():
+                try:
+                    offset = ranges.popleft()
+                except IndexError:
+                    break
+                end = min(offset + self.chunk_size, len(data))
+                fp.seek(offset)
+                try:
+                    fp.write(data[offset:end])
+                except Exception:
+                    self.__failed.set()
+                    raise
+                progress.update(end - offset)
+
+    def upload(self, src_path, des_path):
+        """
+        :param src_path: Local file to upload
+        :param des_path: Remote file path. If it is a directory, the file
+                         is uploaded into it
+        :return: paramiko.SFTPAttributes of the uploaded file
+        """
+        size = os.path.getsize(src_path)
+        sftp = self.shell.get_sftp_client()
+        des_path = get_remote_file_path(sftp, src_path, des_path)
+        progress = TransferProgress(size, self.callback)
+        if size < self.min_size:
+            return sftp.put(src_path, des_path,
+                            callback=progress.get_sftp_callback())
+
+        # Creates / truncates the file, the ranges are written into it
+        sftp.open(des_path, "wb").close()
+        self.send_ranges(src_path, des_path,
+                         list(range(0, size, self.chunk_size)), progress)
+        attr = sftp.stat(des_path)
+        if attr.st_size != size:
+            raise IOError("size mismatch in put!  {} != {}"
+                          .format(attr.st_size, size))
+        log.info("{} - Uploaded {} ({:.1f} MiB) in {:.1f} secs at {:.1f} MiB/s"
+                 .format(self.shell.ip, des_path, size / 1048576.0,
+                         time.time() - progress.start_time,
+                         progress.get_rate() / 1048576.0))
+        return attr
+
+    def send_ranges(self, src_path, des_path, offsets, progress):
+        """
+        Write the given chunks of the local file into the existing remote
+        file
+        :param offsets: Start offsets of the chunks (multiples of
+                        chunk_size) to send
+        :param progress: TransferProgress object
+        """
+        ranges = deque(offsets)
+        if not ranges:
+            return
+        sftp_clients, slots = self.__open_sftp_clients(len(ranges))
+        self.__failed.clear()
+        error = None
+        try:
+            with open(src_path, "rb") as fp, \
+                    mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = memoryview(mm)
+                try:
+                    with ThreadPoolExecutor(
+                            max_workers=len(sftp_clients)) as executor:
+                        futures = [executor.submit(self.__upload_ranges,
+                                                   client, des_path, data,
+                                                   ranges, progress)
+                                   for client in sftp_clients]
+                    errors = [future.exception() for future in futures]
+                    error = next((e for e in errors if e is not None), None)
+                    del futures, errors
+                    if error is not None:
+                        # The frames of the traceback still reference
+                        # slices of the mapping, closing it would fail
+                        clear_exception_frames(error)
+                finally:
+                    data.release()
+        finally:
+            for client in sftp_clients[1:]:
+                try:
+                    client.close()
+                except Exception as e:
+                    log.debug("Error while closing SFTP session: {}"
+                              .format(e))
+            for _ in range(slots):
+                self.shell._session_slots.release()
+        if error is not None:
+            raise error
+        log.debug("{} - Sent {} chunks of {} using {} SFTP sessions"
+                  .format(self.shell.ip, len(offsets), des_path,
+                          len(sftp_clients)))
+
+
+class ResumableTransfer(object):
+    """
+    put() / get() of large files, continuing interrupted transfers.
+
+    Data is written to '<destination>.part' first. If that file is left
+    from an earlier attempt, sha256 digests of its chunks are computed on
+    both ends and only missing or differing chunks are transferred again.
+    Remote digests are computed on the node by a single command, so only
+    the digests go over the wire. The part file is renamed to the
+    destination once the sha256 of the whole file matches on both ends.
+    The sha256 of a local source file is cached, see LocalDigestCache.
+    Files smaller than min_size are copied with a plain sftp.put() / get()
+    and then verified the same way.
+    """
+    part_suffix = ".part"
+    min_size = ParallelUploader.min_size
+    chunk_size = ParallelUploader.chunk_size
+
+    def __init__(self, shell, callback=None, chunk_size=None):
+        """
+        :param shell: Connected ShellConnection object
+        :param callback: Optional progress callback, called with
+                         (transferred_bytes, total_bytes, bytes_per_sec)
+        :param chunk_size: Size of the chunks compared on resume
+        """
+        self.shell = shell
+        self.callback = callback
+        self.chunk_size = chunk_size or self.chunk_size
+
+    def __get_remote_digests(self, script, expected):
+        output, _ = self.shell.execute_command_raw(script, debug=False)
+        digests = [line[:64] for line in output
+                   if re.match(r"^[0-9a-f]{64}\b", line)]
+        if len(digests) != expected:
+            log.warning("{} - Unable to compute sha256 on the node"
+                        .format(self.shell.ip))
+            return None
+        return digests
+
+    def get_remote_chunk_digests(self, path, num_chunks):
+        """
+        :return: List of sha256 hex digests of the first num_chunks chunks
+                 of the remote file, None if they couldn't be computed
+        """
+        return self.__get_remote_digests(
+            REMOTE_CHUNK_DIGESTS_SCRIPT.format(path=shlex.quote(path),
+                                               num_chunks=num_chunks,
+                                               chunk_size=self.chunk_size),
+            num_chunks)
+
+    def get_remote_digest(self, path):
+        """
+        :return: sha256 hex digest of the remote file or None
+        """
+        digests = self.__get_remote_digests(
+            REMOTE_DIGEST_SCRIPT.format(path=shlex.quote(path)), 1)
+        return digests[0] if digests else None
+
+    def get_local_digests(self, path, num_chunks=None):
+        """
+        :return: Tuple of (list of sha256 hex digests of the first
+                 num_chunks chunks, sha256 hex digest of all data read)
+        """
+        chunk_digests = list()
+        digest = hashlib.sha256()
+        with open(path, "rb") as fp:
+            while num_chunks is None or len(chunk_digests) < num_chunks:
+                data = fp.read(self.chunk_size)
+                if not data:
+                    break
+                chunk_digests.append(hashlib.sha256(data).hexdigest())
+                digest.update(data)
+        return chunk_digests, digest.hexdigest()
+
+    def __get_pending_offsets(self, size, local_digests, remote_digests):
+        """
+        :return: Offsets of the chunks which are not in the part file yet
+        """
+        offsets = list(range(0, size, self.chunk_size))
+        if local_digests is None or remote_digests is None:
+            return offsets
+        pending = [offset for index, offset in enumerate(offsets)
+                   if index >= len(local_digests)
+                   or index >= len(remote_digests)
+                   or local_digests[index] != remote_digests[index]]
+        log.info("{} - Resuming transfer, {} of {} chunks present"
+                 .format(self.shell.ip, len(offsets) - len(pending),
+                         len(offsets)))
+        return pending
+
+    def __get_num_chunks(self, size, part_size):
+        return min((size + self.chunk_size - 1) // self.chunk_size,
+                   (part_size + self.chunk_size - 1) // self.chunk_size)
+
+    def __get_progress(self, size, offsets):
+        pending = sum([min(self.chunk_size, size - offset)
+                       for offset in offsets])
+        return TransferProgress(size, self.callback, size - pending)
+
+    def __verify(self, local_digest, remote_digest, path):
+        if remote_digest is None:
+            log.warning("{} - Skipping sha256 check of {}"
+                        .format(self.shell.ip, path))
+            return
+        if local_digest != remote_digest:
+            raise IOError("sha256 mismatch for {}: {} != {}"
+                          .format(path, local_digest, remote_digest))
+
+    def put(self, local_path, remote_path):
+        """
+        :param local_path: Local file to upload
+        :param remote_path: Remote file path or an existing remote directory
+        :return: paramiko.SFTPAttributes of the uploaded file
+        """
+        size = os.path.getsize(local_path)
+        sftp = self.shell.get_sftp_client()
+        remote_path = get_remote_file_path(sftp, local_path, remote_path)
+        local_digest = LocalDigestCache.get(local_path)
+        if size < self.min_size:
+            attr = sftp.put(local_path, remote_path,
+                            callback=TransferProgress(size, self.callback)
+                            .get_sftp_callback())
+            self.__verify(local_digest, self.get_remote_digest(remote_path),
+                          remote_path)
+            return attr
+
+        part_path = remote_path + self.part_suffix
+        try:
+            part_size = sftp.stat(part_path).st_size
+        except IOError:
+            part_size = 0
+            sftp.open(part_path, "wb").close()
+        local_digests = remote_digests = None
+        num_chunks = self.__get_num_chunks(size, part_size)
+        if num_chunks:
+            # Only needed to resume, the full digest comes from the cache
+            remote_digests = self.get_remote_chunk_digests(part_path,
+                                                           num_chunks)
+            local_digests, _ = self.get_local_digests(local_path, num_chunks)
+        offsets = self.__get_pending_offsets(size, local_digests,
+                                             remote_digests)
+        if part_size > size:
+            sftp.truncate(part_path, size)
+        progress = self.__get_progress(size, offsets)
+        ParallelUploader(self.shell, chunk_size=self.chunk_size) \
+            .send_ranges(local_path, part_path, offsets, progress)
+        self.__verify(local_digest, self.get_remote_digest(part_path),
+                      remote_path)
+        rename_remote_file(sftp, part_path, remote_path)
+        log.info("{} - Uploaded {} ({:.1f} MiB, sha256 {})"
+                 .format(self.shell.ip, remote_path, size / 1048576.0,
+                         local_digest))
+        return sftp.stat(remote_path)
+
+    def get(self, remote_path, local_path):
+        """
+        :param remote_path: Remote file to download
+        :param local_path: Local file path
+        :return: Size of the downloaded file
+        """
+        sftp = self.shell.get_sftp_client()
+        size = sftp.stat(remote_path).st_size
+        if size < self.min_size:
+            sftp.get(remote_path, local_path,
+                     callback=TransferProgress(size, self.callback)
+                     .get_sftp_callback())
+            self.__verify(self.get_local_digests(local_path)[1],
+                          self.get_remote_digest(remote_path), remote_path)
+            return size
+
+        part_path = local_path + self.part_suffix
+        part_size = 0
+        if os.path.exists(part_path):
+            part_size = os.path.getsize(part_path)
+        else:
+            open(part_path, "wb").close()
+        local_digests = remote_digests = None
+        num_chunks = self.__get_num_chunks(size, part_size)
+        if num_chunks:
+            remote_digests = self.get_remote_chunk_digests(remote_path,
+                                                           num_chunks)
+            local_digests, _ = self.get_local_digests(part_path, num_chunks)
+        offsets = self.__get_pending_offsets(size, local_digests,
+                                             remote_digests)
+        progress = self.__get_progress(size, offsets)
+        with open(part_path, "r+b") as fp:
+            fp.truncate(size)
+            with sftp.open(remote_path, "rb") as remote_fp:
+                for offset in offsets:
+                    length = min(self.chunk_size, size - offset)
+                    fp.seek(offset)
+                    # readv() pipelines the read requests of the chunk
+                    for data in remote_fp.readv([(offset, length)]):
+                        fp.write(data)
+                    progress.update(length)
+        self.__verify(self.get_local_digests(part_path)[1],
+                      self.get_remote_digest(remote_path), remote_path)
+        os.replace(part_path, local_path)
+        log.info("{} - Downloaded {} ({:.1f} MiB) in {:.1f} secs"
+                 .format(self.shell.ip, remote_path, size / 1048576.0,
+                         time.time() - progress.start_time))
+        return size
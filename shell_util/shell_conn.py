@@ -1,24 +1,119 @@
+import hashlib
 import logging
 import os
+import platform
 import weakref
 
 import paramiko
+import shlex
 import signal
+import threading
 import time
 import uuid
-from subprocess import Popen, PIPE
 from time import sleep
 
 from shell_util.common_api import CommonShellAPIs
+from shell_util.connection_monitor import ConnectionMonitor, probe_transport
+from shell_util.connection_pool import SSHConnectionPool
 from shell_util.remote_machine import RemoteMachineInfo, RemoteMachineProcess
+from shell_util.retry_policy import RetryPolicy
+from shell_util.sftp_client import SharedSFTPClient
+from shell_util.shell_session import LocalShellSession, RemoteShellSession
 
 log = logging.getLogger("shell_util")
 log.setLevel("INFO")
 
+OS_DISTRO_DICT = {'ubuntu': 'Ubuntu', 'debian': 'Ubuntu',
+                  'mint': 'Ubuntu',
+                  'centos': 'CentOS',
+                  'openshift': 'CentOS',
+                  'amazon linux 2': 'CentOS',
+                  'amazon linux 2023': 'CentOS',
+                  'opensuse': 'openSUSE',
+                  'red': 'Red Hat',
+                  'suse': 'SUSE',
+                  'oracle': 'Oracle Linux',
+                  'almalinux': 'AlmaLinux OS',
+                  'rocky': 'Rocky Linux'}
+OS_SHORTNAME_DICT = {'ubuntu': 'ubuntu', 'mint': 'ubuntu',
+                     'debian': 'debian',
+                     'centos': 'centos',
+                     'openshift': 'centos',
+                     'suse': 'suse',
+                     'opensuse': 'suse',
+                     'amazon linux 2': 'amzn2',
+                     'amazon linux 2023': 'al2023',
+                     'red': 'rhel',
+                     'oracle': 'oel',
+                     'almalinux': 'alma',
+                     'rocky': 'rocky'}
+DELIVERABLE_TYPE_DICT = {'Ubuntu': 'deb',
+                         'CentOS': 'rpm',
+                         'Red Hat': 'rpm',
+                         'openSUSE': 'rpm',
+                         'SUSE': 'rpm',
+                         'Oracle Linux': 'rpm',
+                         'Amazon Linux 2023': 'rpm',
+                         'Amazon Linux 2': 'rpm',
+                         'AlmaLinux OS': 'rpm',
+                         'Rocky Linux': 'rpm',
+                         'Mac': 'dmg',
+                         'Debian': 'deb'}
+
+# Collects everything extract_remote_info() needs in a single round trip.
+# Each fact is printed as a section, started by '<marker> <section_name>'.
+# The release file sections are only printed if the file exists and
+# 'win_ini' only on Windows (cygwin) machines.
+FACTS_SCRIPT = """
+m='{marker}'
+s() {{ printf '\\n%s %s\\n' "$m" "$1"; }}
+ver=$(sw_vers 2>/dev/null | grep ProductVersion | awk '{{ print $2 }}')
+s sw_vers; [ -n "$ver" ] && echo "$ver"
+for f in os-release system-release redhat-release; do
+    [ -e /etc/$f ] && s $f && cat /etc/$f
+done
+[ -e /cygdrive/c/Windows/win.ini ] && s win_ini
+s arch; uname -m
+if [ -n "$ver" ]; then
+    s cpu; /sbin/sysctl -n machdep.cpu.brand_string
+    s ram; /sbin/sysctl -n hw.memsize
+    s disk; df -hl
+else
+    s cpu; cat /proc/cpuinfo
+    s ram; cat /proc/meminfo
+    s disk; df -Thl
+fi
+s hostname; hostname
+s domain; hostname -d 2>/dev/null
+s domain_err; hostname -d 2>&1 >/dev/null
+s end
+"""
+
 
 class ShellConnection(CommonShellAPIs):
     connections = 0
     disconnections = 0
+    # Number of SSH handshakes (TCP connect + kex + auth) actually performed
+    handshakes = 0
+    # Matches the default 'MaxSessions' value of OpenSSH's sshd
+    max_sessions = 10
+    retry_policy = RetryPolicy()
+    # Secs between SSH keepalive packets, 0 disables them
+    keepalive_interval = 30
+    # Secs between background liveness probes, 0 disables the monitor
+    liveness_check_interval = 0
+    # SSH client implementation, paramiko.SSHClient or a compatible class
+    # like shell_util.openssh_client.OpenSSHClient
+    ssh_client_class = paramiko.SSHClient
+    # Run local commands through one long lived shell process instead of
+    # spawning a new shell for every command
+    persistent_local_shell = False
+    # Run remote commands without a PTY through one shell channel
+    # (invoke_shell) instead of opening a new channel for each command.
+    # Note: Commands see the environment of a login shell then
+    persistent_remote_shell = False
+    # TransportProfile of the SSH transport, None for the client's defaults
+    transport_profile = None
     __refs__ = list()
 
     @classmethod
@@ -45,8 +140,99 @@ class ShellConnection(CommonShellAPIs):
         self.log = log
         ShellConnection.connections += 1
 
-        self._ssh_client = paramiko.SSHClient()
-        self._ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self._pool_key = None
+        self._sftp_client = None
+        self._ssh_client = self.__new_ssh_client()
+
+        # Guards (re)connection and SFTP setup against concurrent callers
+        self._connection_lock = threading.RLock()
+        self._session_slots = None
+        self.set_max_sessions(self.max_sessions)
+        self._monitor = None
+        self._shell_session = None
+
+    def set_max_sessions(self, max_sessions):
+        """
+        Limit the number of commands running in parallel over this
+        connection's SSH transport. One session is kept aside for
+        the cached SFTP channel.
+        :param max_sessions: 'MaxSessions' value configured on the sshd
+        :return: None
+        """
+        self.max_sessions = max_sessions
+        self._session_slots = threading.BoundedSemaphore(
+            max(1, max_sessions - 1))
+
+    def set_transport_profile(self, profile):
+        """
+        Use the given TransportProfile for this connection. An already
+        established remote connection is rebuilt with it.
+        :param profile: TransportProfile object or None for the defaults
+        :return: None
+        """
+        with self._connection_lock:
+            self.transport_profile = profile
+            tp = self._ssh_client.get_transport()
+            if self.remote and tp is not None and tp.active:
+                self.rebuild_connection()
+
+    def __get_connect_kwargs(self, policy, start_time):
+        kwargs = policy.get_connect_kwargs(start_time)
+        if self.transport_profile is not None:
+            kwargs.update(self.transport_profile.get_connect_kwargs(
+                self.ssh_client_class))
+        return kwargs
+
+    def __new_ssh_client(self):
+        ssh_client = self.ssh_client_class()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        return ssh_client
+
+    def __release_ssh_client(self):
+        """
+        Give the current SSH client back to the connection pool (or close it)
+        and replace it with a fresh, unconnected one
+        """
+        self.__close_sftp_client()
+        if self._ssh_client is not None:
+            if self._pool_key is not None:
+                SSHConnectionPool.release(self._pool_key, self._ssh_client)
+            else:
+                self._ssh_client.close()
+        self._pool_key = None
+        self._ssh_client = self.__new_ssh_client()
+
+    def __close_sftp_client(self):
+        if self._sftp_client is not None:
+            try:
+                self._sftp_client.close()
+            except Exception as e:
+                log.debug("Error while closing SFTP session: {}".format(e))
+            self._sftp_client = None
+
+    def get_sftp_client(self):
+        """
+        Returns the SFTP session of this connection. The session is opened
+        lazily on first use and reused for all subsequent calls. A new one is
+        opened if the underlying SSH transport got dropped or replaced.
+        The client is shared by all threads using this connection
+        :return: SharedSFTPClient object
+        """
+        with self._connection_lock:
+            self.reconnect_if_inactive()
+            tp = self._ssh_client.get_transport()
+            if self._sftp_client is not None:
+                channel = self._sftp_client.get_channel()
+                if channel.closed or channel.get_transport() is not tp:
+                    self.__close_sftp_client()
+            if self._sftp_client is None:
+                self._sftp_client = SharedSFTPClient.from_transport(tp)
+            return self._sftp_client
+
+    @staticmethod
+    def __read_local_file(file_path):
+        with open(file_path, 'rb') as fp:
+            return fp.read()
 
     def get_hostname(self):
         o, r = self.execute_command_raw('hostname', debug=False)
@@ -77,6 +263,8 @@ class ShellConnection(CommonShellAPIs):
         elif mac:
             o, r = self.execute_command_raw(
                 '/sbin/sysctl -n machdep.cpu.brand_string')
+        elif not self.remote and os.path.exists('/proc/cpuinfo'):
+            o = self.__read_local_file('/proc/cpuinfo')
         else:
             o, r = self.execute_command_raw('cat /proc/cpuinfo', debug=False)
         if o:
@@ -94,6 +282,8 @@ class ShellConnection(CommonShellAPIs):
         elif mac:
             o, r = self.execute_command_raw(
                 '/sbin/sysctl -n hw.memsize', debug=False)
+        elif not self.remote and os.path.exists('/proc/meminfo'):
+            o = self.__read_local_file('/proc/meminfo')
         else:
             o, r = self.execute_command_raw('cat /proc/meminfo', debug=False)
         if o:
@@ -122,73 +312,226 @@ class ShellConnection(CommonShellAPIs):
                                       self.server.ssh_key)
 
     def ssh_connect_with_retries(self, ip, ssh_username, ssh_password, ssh_key,
-                                 exit_on_failure=False, max_attempts_connect=5,
-                                 backoff_time=10):
-        # Retries with exponential backoff delay
-        attempt = 0
-        is_ssh_ok = False
-        while not is_ssh_ok and attempt < max_attempts_connect:
-            attempt += 1
-            log.debug("SSH Connecting to {} with username:{}, attempt#{} of {}"
-                      .format(ip, ssh_username, attempt, max_attempts_connect))
-            try:
-                if self.remote and ssh_key == '':
-                    self._ssh_client.connect(
-                        hostname=ip.replace('[', '').replace(']', ''),
-                        username=ssh_username, password=ssh_password,
-                        look_for_keys=False)
-                elif self.remote:
-                    self._ssh_client.connect(
-                        hostname=ip.replace('[', '').replace(']', ''),
-                        username=ssh_username, key_filename=ssh_key,
-                        look_for_keys=False)
-                is_ssh_ok = True
-            except paramiko.BadHostKeyException as bhke:
-                log.error("Can't establish SSH (Invalid host key) to {}: {}"
-                          .format(ip, bhke))
-                raise Exception(bhke)
-            except Exception as e:
-                log.error("Can't establish SSH (unknown reason) to {}: {}"
-                          .format(ip, e, ssh_username, ssh_password))
-                if attempt < max_attempts_connect:
-                    log.info("Retrying with back off delay for {} secs."
-                             .format(backoff_time))
-                    self.sleep(backoff_time)
-                    backoff_time *= 2
-
-        if not is_ssh_ok:
-            error_msg = ("-->No SSH connectivity to {} even after {} times!\n"
-                         .format(self.ip, attempt))
-            log.error(error_msg)
-            if exit_on_failure:
-                log.error("Exit on failure: killing process")
-                os.kill(os.getpid(), signal.SIGKILL)
-            else:
-                log.error("No exit on failure, raise exception")
-                raise Exception(error_msg)
+                                 exit_on_failure=False,
+                                 max_attempts_connect=None, backoff_time=None,
+                                 retry_policy=None):
+        """
+        Connect to the given ip, retrying as per the RetryPolicy.
+        :param max_attempts_connect: Overrides policy's max_attempts
+        :param backoff_time: Overrides policy's base_delay
+        :param retry_policy: RetryPolicy to use instead of self.retry_policy
+        """
+        policy = retry_policy or self.retry_policy
+        if max_attempts_connect is not None:
+            policy = policy.copy(max_attempts=max_attempts_connect)
+        if backoff_time is not None:
+            policy = policy.copy(base_delay=backoff_time)
+        with self._connection_lock:
+            if self.remote:
+                pool_key = SSHConnectionPool.get_key(
+                    ip, ssh_username, ssh_key,
+                    client_type=self.ssh_client_class.__name__,
+                    profile=getattr(self.transport_profile, "name", ''),
+                    ssh_password=ssh_password)
+                self.__release_ssh_client()
+                ssh_client = SSHConnectionPool.acquire(pool_key)
+                if ssh_client is not None:
+                    self._ssh_client = ssh_client
+                    self._pool_key = pool_key
+                    self.__on_connected()
+                    return
+            # Retries with jittered exponential backoff delay
+            attempt = 0
+            is_ssh_ok = False
+            start_time = time.time()
+            while not is_ssh_ok and attempt < policy.max_attempts:
+                attempt += 1
+                log.debug("SSH Connecting to {} with username:{}, attempt#{} of {}"
+                          .format(ip, ssh_username, attempt, policy.max_attempts))
+                try:
+                    if self.remote and ssh_key == '':
+                        self._ssh_client.connect(
+                            hostname=ip.replace('[', '').replace(']', ''),
+                            username=ssh_username, password=ssh_password,
+                            look_for_keys=False,
+                            **self.__get_connect_kwargs(policy, start_time))
+                    elif self.remote:
+                        self._ssh_client.connect(
+                            hostname=ip.replace('[', '').replace(']', ''),
+                            username=ssh_username, key_filename=ssh_key,
+                            look_for_keys=False,
+                            **self.__get_connect_kwargs(policy, start_time))
+                    if self.remote:
+                        ShellConnection.handshakes += 1
+                        self._pool_key = pool_key
+                        self.__on_connected()
+                    is_ssh_ok = True
+                except paramiko.BadHostKeyException as bhke:
+                    log.error("Can't establish SSH (Invalid host key) to {}: {}"
+                              .format(ip, bhke))
+                    raise Exception(bhke)
+                except Exception as e:
+                    if policy.is_fatal(e):
+                        log.error("Can't establish SSH to {}, not retrying: {}"
+                                  .format(ip, e))
+                        break
+                    log.error("Can't establish SSH (unknown reason) to {}: {}"
+                              .format(ip, e))
+                    if attempt < policy.max_attempts:
+                        delay = policy.get_backoff(attempt)
+                        remaining = policy.get_remaining(start_time)
+                        if remaining is not None and remaining <= delay:
+                            log.error("Deadline of {} secs reached for {}"
+                                      .format(policy.deadline, ip))
+                            break
+                        log.info("Retrying with back off delay for {:.1f} secs."
+                                 .format(delay))
+                        self.sleep(delay)
+
+            if not is_ssh_ok:
+                error_msg = ("-->No SSH connectivity to {} even after {} times!\n"
+                             .format(self.ip, attempt))
+                log.error(error_msg)
+                if exit_on_failure:
+                    log.error("Exit on failure: killing process")
+                    os.kill(os.getpid(), signal.SIGKILL)
+                else:
+                    log.error("No exit on failure, raise exception")
+                    raise Exception(error_msg)
+
+    def __on_connected(self):
+        tp = self._ssh_client.get_transport()
+        if tp is not None:
+            tp.set_keepalive(self.keepalive_interval)
+        if self.liveness_check_interval and self._monitor is None:
+            self.start_liveness_monitor(self.liveness_check_interval)
+
+    def start_liveness_monitor(self, interval=30, probe_timeout=10):
+        """
+        Start a background thread which probes the SSH transport every
+        'interval' secs and rebuilds it if the server stops responding
+        :param interval: Secs between two probes
+        :param probe_timeout: Secs to wait for the server's response
+        :return: ConnectionMonitor object
+        """
+        self.stop_liveness_monitor()
+        self._monitor = ConnectionMonitor(self, interval, probe_timeout)
+        self._monitor.start()
+        return self._monitor
+
+    def stop_liveness_monitor(self):
+        if self._monitor is not None:
+            self._monitor.stop()
+            self._monitor = None
+
+    def is_connection_alive(self, probe_timeout=10):
+        """
+        Round trip check of the SSH transport with a keepalive request,
+        see probe_transport()
+        :param probe_timeout: Secs to wait for the server's response
+        :return: False if the transport is down or the server didn't answer
+        """
+        if self._ssh_client is None:
+            return False
+        if probe_transport(self._ssh_client.get_transport(), probe_timeout):
+            return True
+        log.debug("{} - SSH liveness probe failed".format(self.ip))
+        return False
+
+    def rebuild_connection(self):
+        """
+        Drop the current SSH transport and connect again
+        """
+        with self._connection_lock:
+            self.__close_sftp_client()
+            self._ssh_client.close()
+            self.ssh_connect_with_retries(
+                self.ip, self.server.ssh_username,
+                self.server.ssh_password, self.server.ssh_key)
 
     def reconnect_if_inactive(self):
         """
         If the SSH channel is inactive, retry the connection
         """
-        tp = self._ssh_client.get_transport()
-        if tp and not tp.active:
-            log.warning("SSH connection to {} inactive, reconnecting..."
-                        .format(self.ip))
-            self.ssh_connect_with_retries(
-                self.ip, self.server.ssh_username, self.server.ssh_password,
-                self.server.ssh_key)
+        with self._connection_lock:
+            tp = self._ssh_client.get_transport()
+            if tp and not tp.active:
+                log.warning("SSH connection to {} inactive, reconnecting..."
+                            .format(self.ip))
+                self.ssh_connect_with_retries(
+                    self.ip, self.server.ssh_username,
+                    self.server.ssh_password, self.server.ssh_key)
+
+    def get_shell_session(self):
+        """
+        :return: ShellSession used to run commands or None if disabled
+                 for this connection. See persistent_local_shell and
+                 persistent_remote_shell
+        """
+        if self.remote and not self.persistent_remote_shell \
+                or not self.remote and not self.persistent_local_shell:
+            return None
+        with self._connection_lock:
+            if self._shell_session is None:
+                if self.remote:
+                    self._shell_session = RemoteShellSession(self)
+                else:
+                    self._shell_session = LocalShellSession()
+            return self._shell_session
 
     def disconnect(self):
         ShellConnection.disconnections += 1
-        self._ssh_client.close()
+        self.stop_liveness_monitor()
+        with self._connection_lock:
+            if self._shell_session is not None:
+                self._shell_session.close()
+                self._shell_session = None
+            self.__release_ssh_client()
+
+    def adopt_connection(self, shell):
+        """
+        Take over the already established SSH session of another
+        ShellConnection, so no fresh handshake is required.
+        The donor connection is left without a client and must not be used
+        afterwards. Its liveness monitor is stopped, this connection starts
+        its own one if enabled.
+        :param shell: ShellConnection object holding an active session
+        :return: None
+        """
+        shell.stop_liveness_monitor()
+        with shell._connection_lock:
+            if shell._shell_session is not None:
+                shell._shell_session.close()
+                shell._shell_session = None
+        with self._connection_lock:
+            self.__close_sftp_client()
+            self._ssh_client.close()
+            self._ssh_client = shell._ssh_client
+            self._pool_key = shell._pool_key
+            self._sftp_client = shell._sftp_client
+            shell._ssh_client = None
+            shell._pool_key = None
+            shell._sftp_client = None
+            self.__on_connected()
+
+    def get_host_key_fingerprint(self):
+        """
+        :return: SHA256 hex digest of the server's host key.
+                 'localhost' for local connections, None if not connected
+        """
+        if not self.remote:
+            return "localhost"
+        tp = self._ssh_client.get_transport()
+        if tp is None or not tp.active:
+            return None
+        return hashlib.sha256(tp.get_remote_server_key().asbytes()).hexdigest()
 
     def __find_windows_info(self):
         if self.remote:
             found = self.find_file("/cygdrive/c/tmp", "windows_info.txt")
             if isinstance(found, str):
                 if self.remote:
-                    sftp = self._ssh_client.open_sftp()
+                    sftp = self.get_sftp_client()
                     try:
                         f = sftp.open(found)
                         log.info("get windows information")
@@ -198,10 +541,10 @@ class ShellConnection(CommonShellAPIs):
                             key = key.strip(' \t\n\r')
                             value = value.strip(' \t\n\r')
                             info[key] = value
+                        f.close()
                         return info
                     except IOError:
                         log.error("can not find windows info file")
-                    sftp.close()
             else:
                 return self.create_windows_info()
         else:
@@ -264,36 +607,213 @@ class ShellConnection(CommonShellAPIs):
         info.update(systeminfo)
         self.execute_batch_command("rm -rf  /cygdrive/c/tmp/windows_info.txt")
         self.execute_batch_command("touch  /cygdrive/c/tmp/windows_info.txt")
-        sftp = self._ssh_client.open_sftp()
+        sftp = self.get_sftp_client()
         try:
             f = sftp.open('/cygdrive/c/tmp/windows_info.txt', 'w')
             content = ''
             for key in sorted(info.keys()):
                 content += '{0} = {1}\n'.format(key, info[key])
             f.write(content)
+            f.close()
             log.info("/cygdrive/c/tmp/windows_info.txt was created with content: {0}".format(content))
         except IOError:
             log.error('Can not write windows_info.txt file')
-        finally:
-            sftp.close()
         return info
 
+    @staticmethod
+    def __parse_os_release(lines):
+        """
+        :param lines: Lines of /etc/os-release
+        :return: Tuple of (os_distro, os_version, is_linux_distro)
+        """
+        os_distro = ''
+        os_version = ''
+        is_linux_distro = False
+        os_pretty_name = ''
+        for line in lines:
+            log.debug(line)
+            if line.startswith('VERSION_ID'):
+                os_version = line.split('=')[1].replace('"', '')
+                os_version = os_version.rstrip('\n').rstrip(' ').rstrip('\\l').rstrip(
+                    ' ').rstrip('\\n').rstrip(' ')
+            elif line.startswith('PRETTY_NAME'):
+                os_pretty_name = line.split('=')[1].replace('"', '')
+
+        log.debug("os_pretty_name:" + os_pretty_name)
+        if os_pretty_name and "Amazon Linux 2" not in os_pretty_name:
+            os_name = os_pretty_name.split(' ')[0].lower()
+            os_distro = OS_DISTRO_DICT[os_name]
+            if os_name != 'ubuntu':
+                os_version = OS_SHORTNAME_DICT[os_name] + " " + os_version.split('.')[0]
+            else:
+                os_version = OS_SHORTNAME_DICT[os_name] + " " + os_version
+            if os_distro:
+                is_linux_distro = True
+        log.info("os_distro: " + os_distro + ", os_version: " + os_version +
+                 ", is_linux_distro: " + str(is_linux_distro))
+        return os_distro, os_version, is_linux_distro
+
+    @staticmethod
+    def __parse_system_release(lines):
+        """
+        Detects Oracle Linux / Amazon Linux 2 from /etc/system-release
+        :return: Tuple of (os_distro, os_version) or None
+        """
+        etc_issue = ''
+        # let's only read the first line
+        for line in lines:
+            # for SuSE that has blank first line
+            if line.rstrip('\n'):
+                etc_issue = line
+                break
+        if etc_issue.lower().find('oracle linux') != -1:
+            dist_version = ''
+            for i in etc_issue:
+                if i.isdigit():
+                    dist_version = i
+                    break
+            return 'Oracle Linux', "oel{}".format(dist_version)
+        elif etc_issue.lower().find('amazon linux 2') != -1 or \
+                etc_issue.lower().find('amazon linux release 2') != -1:
+            # strip all extra characters
+            etc_issue = etc_issue.rstrip('\n').rstrip(' ').rstrip('\\l').rstrip(' ').rstrip('\\n').rstrip(
+                ' ')
+            return 'Amazon Linux 2', etc_issue
+
+    @staticmethod
+    def __parse_redhat_release(lines):
+        """
+        Detects centos 7 / 8 or rhel8 from /etc/redhat-release
+        :return: Tuple of (os_distro, os_version) or None
+        """
+        redhat_release = lines[0] if lines else ''
+        redhat_release = redhat_release.rstrip('\n').rstrip('\\l').rstrip('\\n')
+        """ in ec2: Red Hat Enterprise Linux Server release 7.2 """
+        if redhat_release.lower().find('centos') != -1 \
+                or redhat_release.lower().find('linux server') != -1 \
+                or redhat_release.lower().find('red hat') != -1:
+            if redhat_release.lower().find('release 7') != -1:
+                return 'CentOS', "CentOS 7"
+            elif redhat_release.lower().find('release 8') != -1:
+                return 'CentOS', "CentOS 8"
+            elif redhat_release.lower().find('red hat enterprise') != -1:
+                if "8.0" in redhat_release.lower():
+                    return "Red Hat", "rhel8"
+        else:
+            log.error("Could not find OS name."
+                      "It could be unsupport OS")
+
+    def __read_remote_lines(self, remote_path):
+        with self.get_sftp_client().open(remote_path) as fp:
+            return fp.read().decode(errors='replace').splitlines(True)
+
+    def __create_linux_info(self, os_distro, os_version, os_arch, cpu, disk,
+                            ram, hostname, domain):
+        # at this point we should know if its a linux or windows ditro
+        ext = DELIVERABLE_TYPE_DICT.get(os_distro, '')
+        arch = {'i686': "x86",
+                'i386': "x86"}.get(os_arch, os_arch)
+
+        info = RemoteMachineInfo()
+        info.type = "Linux"
+        info.distribution_type = os_distro
+        info.architecture_type = arch
+        info.ip = self.ip
+        try:
+            info.distribution_version = os_version.decode()
+        except AttributeError:
+            info.distribution_version = os_version
+        info.deliverable_type = ext
+        info.cpu = cpu
+        info.disk = disk
+        info.ram = ram
+        info.hostname = hostname
+        info.domain = domain
+        self.info = info
+        log.info("%s - distribution_type: %s, distribution_version: %s"
+                 % (self.server.ip, info.distribution_type,
+                    info.distribution_version))
+        return info
+
+    def __collect_remote_facts(self):
+        """
+        Runs FACTS_SCRIPT on the remote machine
+        :return: Dict of section name to list of output lines.
+                 None if the script did not run through (e.g. no POSIX sh)
+        """
+        marker = "__ssh_util_facts_{}__".format(uuid.uuid4().hex)
+        script = FACTS_SCRIPT.format(marker=marker)
+        try:
+            output, _ = self.execute_command_raw(
+                "sh -c {}".format(shlex.quote(script)), debug=False)
+        except Exception as e:
+            log.debug("{} - Fact script failed: {}".format(self.ip, e))
+            return None
+        facts = dict()
+        for section in "\n".join(output).split("\n{} ".format(marker))[1:]:
+            name, _, body = section.partition("\n")
+            facts[name] = body.splitlines()
+        if "end" not in facts:
+            log.debug("{} - Incomplete fact script output".format(self.ip))
+            return None
+        return facts
+
+    def __extract_linux_info_in_one_trip(self):
+        """
+        Collects all facts of a Linux / Mac machine using a single command
+        :return: RemoteMachineInfo or None if the step-wise discovery has
+                 to be used instead (Windows, unknown distro, script failure)
+        """
+        facts = self.__collect_remote_facts()
+        if facts is None or "win_ini" in facts:
+            return None
+
+        if facts["sw_vers"]:
+            os_distro = "Mac"
+            os_version = "".join([line + "\n" for line in facts["sw_vers"]])
+        elif "os-release" in facts:
+            os_distro, os_version, is_linux_distro = \
+                self.__parse_os_release(facts["os-release"])
+            if os_distro == "" and "system-release" in facts:
+                os_distro, os_version = self.__parse_system_release(
+                    facts["system-release"]) or (os_distro, os_version)
+            if os_distro == "" and "redhat-release" in facts:
+                os_distro, os_version = self.__parse_redhat_release(
+                    facts["redhat-release"]) or (os_distro, os_version)
+            if os_distro == "":
+                return None
+        else:
+            os_distro = "linux"
+            os_version = "default"
+
+        return self.__create_linux_info(
+            os_distro, os_version, "".join(facts["arch"]),
+            cpu=facts["cpu"] or None, disk=facts["disk"] or None,
+            ram=facts["ram"] or None, hostname=facts["hostname"] or None,
+            domain=(facts["domain"], facts["domain_err"]))
+
     def extract_remote_info(self):
+        self.use_sudo = False
+        self.reconnect_if_inactive()
+        if self.remote:
+            info = self.__extract_linux_info_in_one_trip()
+            if info is not None:
+                return info
+            log.debug("{} - Falling back to step-wise machine discovery"
+                      .format(self.ip))
+
         # initialize params
         os_distro = "linux"
         os_version = "default"
         is_linux_distro = True
-        self.use_sudo = False
         is_mac = False
-        self.reconnect_if_inactive()
         mac_check_cmd = "sw_vers | grep ProductVersion | awk '{ print $2 }'"
         if self.remote:
             stdin, stdout, stderro = self._ssh_client.exec_command(mac_check_cmd)
             stdin.close()
             ver, err = stdout.read(), stderro.read()
         else:
-            p = Popen(mac_check_cmd, shell=True, stdout=PIPE, stderr=PIPE)
-            ver, err = p.communicate()
+            ver, err = self.execute_command_raw(mac_check_cmd, debug=False)
 
         if not err and ver:
             os_distro = "Mac"
@@ -307,73 +827,13 @@ class ShellConnection(CommonShellAPIs):
             self.use_sudo = False
         elif self.remote:
             is_mac = False
-            sftp = self._ssh_client.open_sftp()
+            sftp = self.get_sftp_client()
             filenames = sftp.listdir('/etc/')
-            os_distro = ''
-            os_version = ''
-            is_linux_distro = False
-            for name in filenames:
-                if name == 'os-release':
-                    # /etc/os-release - likely standard across linux distros
-                    filename = 'etc-os-release-{0}'.format(uuid.uuid4())
-                    sftp.get(localpath=filename, remotepath='/etc/os-release')
-                    file = open(filename)
-                    line = file.readline()
-                    is_version_id = False
-                    is_pretty_name = False
-                    os_pretty_name = ''
-                    while line and (not is_version_id or not is_pretty_name):
-                        log.debug(line)
-                        if line.startswith('VERSION_ID'):
-                            os_version = line.split('=')[1].replace('"', '')
-                            os_version = os_version.rstrip('\n').rstrip(' ').rstrip('\\l').rstrip(
-                                ' ').rstrip('\\n').rstrip(' ')
-                            is_version_id = True
-                        elif line.startswith('PRETTY_NAME'):
-                            os_pretty_name = line.split('=')[1].replace('"', '')
-                            is_pretty_name = True
-                        line = file.readline()
-
-                    os_distro_dict = {'ubuntu': 'Ubuntu', 'debian': 'Ubuntu',
-                                      'mint': 'Ubuntu',
-                                      'centos': 'CentOS',
-                                      'openshift': 'CentOS',
-                                      'amazon linux 2': 'CentOS',
-                                      'amazon linux 2023': 'CentOS',
-                                      'opensuse': 'openSUSE',
-                                      'red': 'Red Hat',
-                                      'suse': 'SUSE',
-                                      'oracle': 'Oracle Linux',
-                                      'almalinux': 'AlmaLinux OS',
-                                      'rocky': 'Rocky Linux'}
-                    os_shortname_dict = {'ubuntu': 'ubuntu', 'mint': 'ubuntu',
-                                         'debian': 'debian',
-                                         'centos': 'centos',
-                                         'openshift': 'centos',
-                                         'suse': 'suse',
-                                         'opensuse': 'suse',
-                                         'amazon linux 2': 'amzn2',
-                                         'amazon linux 2023': 'al2023',
-                                         'red': 'rhel',
-                                         'oracle': 'oel',
-                                         'almalinux': 'alma',
-                                         'rocky': 'rocky'}
-                    log.debug("os_pretty_name:" + os_pretty_name)
-                    if os_pretty_name and "Amazon Linux 2" not in os_pretty_name:
-                        os_name = os_pretty_name.split(' ')[0].lower()
-                        os_distro = os_distro_dict[os_name]
-                        if os_name != 'ubuntu':
-                            os_version = os_shortname_dict[os_name] + " " + os_version.split('.')[0]
-                        else:
-                            os_version = os_shortname_dict[os_name] + " " + os_version
-                        if os_distro:
-                            is_linux_distro = True
-                    log.info("os_distro: " + os_distro + ", os_version: " + os_version +
-                             ", is_linux_distro: " + str(is_linux_distro))
-                    file.close()
-                    # now remove this file
-                    os.remove(filename)
-                    break
+            if 'os-release' in filenames:
+                # /etc/os-release - likely standard across linux distros
+                os_distro, os_version, is_linux_distro = \
+                    self.__parse_os_release(
+                        self.__read_remote_lines('/etc/os-release'))
             else:
                 os_distro = "linux"
                 os_version = "default"
@@ -382,78 +842,19 @@ class ShellConnection(CommonShellAPIs):
                 is_mac = False
                 filenames = []
             """ for Amazon Linux 2 only"""
-            for name in filenames:
-                if name == 'system-release' and os_distro == "":
-                    # it's a amazon linux 2_distro . let's download this file
-                    filename = 'amazon-linux2-release-{0}'.format(uuid.uuid4())
-                    sftp.get(localpath=filename, remotepath='/etc/system-release')
-                    file = open(filename)
-                    etc_issue = ''
-                    # let's only read the first line
-                    for line in file:
-                        # for SuSE that has blank first line
-                        if line.rstrip('\n'):
-                            etc_issue = line
-                            break
-                            # strip all extra characters
-                    if etc_issue.lower().find('oracle linux') != -1:
-                        os_distro = 'Oracle Linux'
-                        for i in etc_issue:
-                            if i.isdigit():
-                                dist_version = i
-                                break
-                        os_version = "oel{}".format(dist_version)
-                        is_linux_distro = True
-                        break
-                    elif etc_issue.lower().find('amazon linux 2') != -1 or \
-                         etc_issue.lower().find('amazon linux release 2') != -1:
-                        etc_issue = etc_issue.rstrip('\n').rstrip(' ').rstrip('\\l').rstrip(' ').rstrip('\\n').rstrip(
-                            ' ')
-                        os_distro = 'Amazon Linux 2'
-                        os_version = etc_issue
-                        is_linux_distro = True
-                        file.close()
-                        # now remove this file
-                        os.remove(filename)
-                        break
+            if 'system-release' in filenames and os_distro == "":
+                release = self.__parse_system_release(
+                    self.__read_remote_lines('/etc/system-release'))
+                if release:
+                    os_distro, os_version = release
+                    is_linux_distro = True
             """ for centos 7 or rhel8 """
-            for name in filenames:
-                if name == "redhat-release" and os_distro == "":
-                    filename = 'redhat-release-{0}'.format(uuid.uuid4())
-                    if self.remote:
-                        sftp.get(localpath=filename, remotepath='/etc/redhat-release')
-                    else:
-                        p = Popen("cat /etc/redhat-release > {0}".format(filename), shell=True, stdout=PIPE, stderr=PIPE)
-                        var, err = p.communicate()
-                    file = open(filename)
-                    redhat_release = ''
-                    for line in file:
-                        redhat_release = line
-                        break
-                    redhat_release = redhat_release.rstrip('\n').rstrip('\\l').rstrip('\\n')
-                    """ in ec2: Red Hat Enterprise Linux Server release 7.2 """
-                    if redhat_release.lower().find('centos') != -1 \
-                         or redhat_release.lower().find('linux server') != -1 \
-                         or redhat_release.lower().find('red hat') != -1:
-                        if redhat_release.lower().find('release 7') != -1:
-                            os_distro = 'CentOS'
-                            os_version = "CentOS 7"
-                            is_linux_distro = True
-                        elif redhat_release.lower().find('release 8') != -1:
-                            os_distro = 'CentOS'
-                            os_version = "CentOS 8"
-                            is_linux_distro = True
-                        elif redhat_release.lower().find('red hat enterprise') != -1:
-                            if "8.0" in redhat_release.lower():
-                                os_distro = "Red Hat"
-                                os_version = "rhel8"
-                                is_linux_distro = True
-                    else:
-                        log.error("Could not find OS name."
-                                  "It could be unsupport OS")
-                    file.close()
-                    os.remove(filename)
-                    break
+            if "redhat-release" in filenames and os_distro == "":
+                release = self.__parse_redhat_release(
+                    self.__read_remote_lines('/etc/redhat-release'))
+                if release:
+                    os_distro, os_version = release
+                    is_linux_distro = True
 
         if self.remote:
             if self.find_file("/cygdrive/c/Windows", "win.ini"):
@@ -484,50 +885,20 @@ class ShellConnection(CommonShellAPIs):
                 os_arch = ''
                 text = stdout.read().splitlines()
             else:
-                p = Popen('uname -m', shell=True, stdout=PIPE, stderr=PIPE)
-                text, err = p.communicate()
+                text = [platform.machine()]
                 os_arch = ''
             for line in text:
                 try:
                     os_arch += line.decode("utf-8")
                 except AttributeError:
                     os_arch += str(line)
-                # at this point we should know if its a linux or windows ditro
-            ext = {'Ubuntu': 'deb',
-                   'CentOS': 'rpm',
-                   'Red Hat': 'rpm',
-                   'openSUSE': 'rpm',
-                   'SUSE': 'rpm',
-                   'Oracle Linux': 'rpm',
-                   'Amazon Linux 2023': 'rpm',
-                   'Amazon Linux 2': 'rpm',
-                   'AlmaLinux OS': 'rpm',
-                   'Rocky Linux': 'rpm',
-                   'Mac': 'dmg',
-                   'Debian': 'deb'}.get(os_distro, '')
-            arch = {'i686': "x86",
-                    'i386': "x86"}.get(os_arch, os_arch)
-
-            info = RemoteMachineInfo()
-            info.type = "Linux"
-            info.distribution_type = os_distro
-            info.architecture_type = arch
-            info.ip = self.ip
-            try:
-                info.distribution_version = os_version.decode()
-            except AttributeError:
-                info.distribution_version = os_version
-            info.deliverable_type = ext
-            info.cpu = self.get_cpu_info(mac=is_mac)
-            info.disk = self.get_disk_info(mac=is_mac)
-            info.ram = self.get_ram_info(mac=is_mac)
-            info.hostname = self.get_hostname()
-            info.domain = self.get_domain()
-            self.info = info
-            log.info("%s - distribution_type: %s, distribution_version: %s"
-                     % (self.server.ip, info.distribution_type,
-                        info.distribution_version))
-            return info
+            return self.__create_linux_info(
+                os_distro, os_version, os_arch,
+                cpu=self.get_cpu_info(mac=is_mac),
+                disk=self.get_disk_info(mac=is_mac),
+                ram=self.get_ram_info(mac=is_mac),
+                hostname=self.get_hostname(),
+                domain=self.get_domain())
 
     def monitor_process(self, process_name, duration_in_seconds=120):
         # monitor this process and return if it crashes
@@ -0,0 +1,286 @@
+import logging
+import os
+import re
+import select
+import shlex
+import socket
+import threading
+import uuid
+import weakref
+from subprocess import PIPE, Popen
+
+from shell_util.channel_reader import READ_SIZE
+
+log = logging.getLogger("shell_util")
+
+
+class ShellSession(object):
+    """
+    Long lived POSIX shell running many commands, one after another.
+
+    Each command runs in a subshell with stdin from /dev/null and is
+    followed by a sentinel line on stdout (carrying the exit code) and on
+    stderr, which marks the end of its output. This saves the process /
+    session setup cost paid for every command otherwise.
+
+    Subclasses provide the shell process through _start(), is_alive(),
+    _write(), _read_chunks() and _stop().
+    """
+    def __init__(self):
+        self.marker = "__ssh_util_{}__".format(uuid.uuid4().hex)
+        self.lock = threading.Lock()
+        self.commands_run = 0
+        # Environment the shell got started with, None if unknown
+        self.env = None
+
+    def get_env_commands(self, env):
+        """
+        :param env: Environment the command has to run with
+        :return: Commands turning the shell's environment into 'env',
+                 None if that isn't possible
+        """
+        commands = list()
+        for name in sorted(set(self.env).union(env)):
+            if self.env.get(name) == env.get(name):
+                continue
+            if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", name):
+                return None
+            if name in env:
+                commands.append("export {}={};"
+                                .format(name, shlex.quote(env[name])))
+            else:
+                commands.append("unset {};".format(name))
+        return " ".join(commands)
+
+    def get_framed_command(self, command, cwd=None, env_commands=""):
+        framed = "( {}eval {} ) </dev/null\n".format(
+            env_commands + " " if env_commands else "", shlex.quote(command))
+        if cwd:
+            framed = "cd {} 2>/dev/null; {}".format(shlex.quote(cwd), framed)
+        return framed + "printf '\\n{0} %d\\n' $?; printf '\\n{0}\\n' >&2\n" \
+            .format(self.marker)
+
+    def run(self, command, timeout=600, cwd=None, blocking=True, env=None):
+        """
+        :param command: Command to run
+        :param timeout: Max. secs to wait for new output of the command.
+                        The shell is killed if it is exceeded.
+                        None to wait forever
+        :param cwd: Directory to run the command in
+        :param blocking: If False, return None instead of waiting while
+                         another command is running in the session
+        :param env: Environment to run the command with. Defaults to the
+                    one of the shell
+        :return: Tuple of (stdout bytes, stderr bytes, exit_code).
+                 None if the session is busy, the shell failed to start or
+                 env can't be applied, so the caller can run the command
+                 on its own
+        """
+        if not self.lock.acquire(blocking):
+            return None
+        try:
+            if not self.is_alive():
+                self._stop()
+                try:
+                    self._start()
+                    # Skips anything the shell printed on startup
+                    self._write(self.get_framed_command("true").encode(
+                        "utf-8", "surrogateescape"))
+                    self.__read_result(timeout)
+                except Exception as e:
+                    log.warning("Unable to start shell session: {}"
+                                .format(e))
+                    self._stop()
+                    return None
+            env_commands = ""
+            if env is not None and self.env is not None:
+                env_commands = self.get_env_commands(env)
+                if env_commands is None:
+                    return None
+            try:
+                self._write(self.get_framed_command(
+                    command, cwd, env_commands).encode("utf-8",
+                                                       "surrogateescape"))
+                result = self.__read_result(timeout)
+            except Exception:
+                # Output of the interrupted command would end up in the
+                # next result, start over with a fresh shell instead
+                self._stop()
+                raise
+            self.commands_run += 1
+            return result
+        finally:
+            self.lock.release()
+
+    def __read_result(self, timeout):
+        markers = {False: "\n{} ".format(self.marker).encode(),
+                   True: "\n{}\n".format(self.marker).encode()}
+        buffers = {False: bytearray(), True: bytearray()}
+        # Offset to continue the marker search at, -1 once found
+        offsets = {False: 0, True: 0}
+        ends = dict()
+        exit_code = None
+        while offsets[False] != -1 or offsets[True] != -1:
+            chunks = self._read_chunks(timeout)
+            if not chunks:
+                raise socket.timeout("No output for {} secs".format(timeout))
+            for is_stderr, data in chunks:
+                if not data:
+                    raise EOFError("Shell session exited")
+                buffers[is_stderr] += data
+            for is_stderr in (False, True):
+                if offsets[is_stderr] == -1:
+                    continue
+                buffer = buffers[is_stderr]
+                marker = markers[is_stderr]
+                index = buffer.find(marker, offsets[is_stderr])
+                if index == -1:
+                    offsets[is_stderr] = max(0, len(buffer) - len(marker))
+                    continue
+                if not is_stderr:
+                    line_end = buffer.find(b"\n", index + len(marker))
+                    if line_end == -1:
+                        offsets[is_stderr] = index
+                        continue
+                    exit_code = int(buffer[index + len(marker):line_end])
+                ends[is_stderr] = index
+                offsets[is_stderr] = -1
+        return bytes(buffers[False][:ends[False]]), \
+            bytes(buffers[True][:ends[True]]), exit_code
+
+    def close(self):
+        with self.lock:
+            self._stop()
+
+    def is_alive(self):
+        raise NotImplementedError()
+
+    def _start(self):
+        raise NotImplementedError()
+
+    def _write(self, data):
+        raise NotImplementedError()
+
+    def _read_chunks(self, timeout):
+        """
+        Wait up to 'timeout' secs for output of the shell
+        :return: List of (is_stderr, data) tuples, empty on timeout.
+                 Empty data means EOF
+        """
+        raise NotImplementedError()
+
+    def _stop(self):
+        raise NotImplementedError()
+
+
+class LocalShellSession(ShellSession):
+    """
+    ShellSession on a local /bin/sh process.
+    The working directory and the differences between this process' current
+    environment and the one the shell got started with are passed along
+    with every command. Background processes started by a command outlive
+    the session, like they do for commands run with Popen.
+    """
+    shell = "/bin/sh"
+
+    def __init__(self):
+        super(LocalShellSession, self).__init__()
+        self.process = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _start(self):
+        self.env = dict(os.environ)
+        self.process = Popen([self.shell], stdin=PIPE, stdout=PIPE,
+                             stderr=PIPE, env=self.env)
+        log.debug("Started local shell session, pid {}"
+                  .format(self.process.pid))
+
+    def _write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def _read_chunks(self, timeout):
+        streams = {self.process.stdout.fileno(): False,
+                   self.process.stderr.fileno(): True}
+        readable, _, _ = select.select(list(streams), [], [], timeout)
+        return [(streams[fd], os.read(fd, READ_SIZE)) for fd in readable]
+
+    def _stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            # Only the shell itself, background processes keep running
+            self.process.kill()
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout,
+                       self.process.stderr):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        self.process = None
+
+
+class RemoteShellSession(ShellSession):
+    """
+    ShellSession on a shell channel (invoke_shell, without a PTY) of a
+    ShellConnection's SSH transport. The channel holds one of the
+    connection's session slots while it is open.
+    """
+    def __init__(self, shell_conn):
+        super(RemoteShellSession, self).__init__()
+        # Weak reference, the connection owns the session
+        self.shell_ref = weakref.ref(shell_conn)
+        self.channel = None
+        self.transport = None
+        self.slot_acquired = False
+
+    def is_alive(self):
+        shell_conn = self.shell_ref()
+        return self.channel is not None and shell_conn is not None \
+            and not self.channel.closed \
+            and not self.channel.exit_status_ready() \
+            and self.transport is shell_conn._ssh_client.get_transport() \
+            and self.transport.is_active()
+
+    def _start(self):
+        shell_conn = self.shell_ref()
+        if not shell_conn._session_slots.acquire(blocking=False):
+            raise Exception("No free session slot on {}"
+                            .format(shell_conn.ip))
+        self.slot_acquired = True
+        self.transport = shell_conn._ssh_client.get_transport()
+        self.channel = self.transport.open_session()
+        self.channel.invoke_shell()
+        log.debug("{} - Started remote shell session".format(shell_conn.ip))
+
+    def _write(self, data):
+        self.channel.sendall(data)
+
+    def _read_chunks(self, timeout):
+        readable, _, _ = select.select([self.channel], [], [], timeout)
+        if not readable:
+            return []
+        chunks = list()
+        while self.channel.recv_stderr_ready():
+            chunks.append((True, self.channel.recv_stderr(READ_SIZE)))
+        while self.channel.recv_ready():
+            chunks.append((False, self.channel.recv(READ_SIZE)))
+        if not chunks and self.channel.eof_received:
+            chunks.append((False, b''))
+        return chunks
+
+    def _stop(self):
+        if self.channel is not None:
+            try:
+                self.channel.close()
+            except Exception as e:
+                log.debug("Error while closing shell session: {}".format(e))
+            self.channel = None
+            self.transport = None
+        shell_conn = self.shell_ref()
+        if self.slot_acquired and shell_conn is not None:
+            shell_conn._session_slots.release()
+        self.slot_acquired = False
@@ -0,0 +1,262 @@
+import logging
+import os
+import shlex
+import socket
+import tarfile
+import time
+
+from paramiko import SSHException
+
+from shell_util.channel_reader import READ_SIZE, decode_lines, drain_channel
+
+log = logging.getLogger("shell_util")
+
+
+# Runs tar in remote_dir on the entries matching the patterns. Nothing is
+# printed if no entry matches, tar would refuse to create an empty archive
+FETCH_TREE_SCRIPT = """
+cd {remote_dir} || exit 2
+set --
+for p in {patterns}; do
+    if [ -e "$p" ] || [ -L "$p" ]; then set -- "$@" "$p"; fi
+done
+[ $# -eq 0 ] || exec tar -{options}f - -- "$@"
+"""
+
+
+class ChannelReader(object):
+    """
+    Minimal file object reading the stdout of a channel
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.channel.recv(size if size > 0 else 1024 * 1024)
+        self.bytes_read += len(data)
+        return data
+
+
+class ChannelWriter(object):
+    """
+    Minimal file object writing into the stdin of a channel. The stderr of
+    the channel is read along, so a remote command writing a lot of errors
+    can't stall on a full channel window while we are still sending.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.error = bytearray()
+
+    def write(self, data):
+        while self.channel.recv_stderr_ready():
+            self.error += self.channel.recv_stderr(READ_SIZE)
+        self.channel.sendall(data)
+        return len(data)
+
+
+class TarStreamTransfer(object):
+    """
+    Copies directory trees as a single tar stream over one exec channel of
+    a ShellConnection, instead of one SFTP round trip (open, write, close)
+    per file. The archive is produced on the fly, nothing is staged on
+    disk. File modes are kept, ownership is the one of the SSH user like
+    for files copied over SFTP.
+    """
+    # Size of the writes into the channel
+    buffer_size = 1024 * 1024
+
+    def __init__(self, shell, compress=False, timeout=600):
+        """
+        :param shell: Connected ShellConnection object
+        :param compress: gzip the stream, for compressible data on slow links
+        :param timeout: Max. secs to wait for the remote tar to finish
+        """
+        self.shell = shell
+        self.compress = compress
+        self.timeout = timeout
+
+    def get_tar_options(self, mode):
+        return "{}{}".format(mode, "z" if self.compress else "")
+
+    @staticmethod
+    def get_shell_glob(pattern):
+        """
+        Quote the pattern for the shell, leaving the glob characters active
+        """
+        return "".join([char if char in "*?[]" else shlex.quote(char)
+                        for char in pattern])
+
+    @staticmethod
+    def check_member(member, local_dir):
+        """
+        Check an entry of a received archive before extracting it
+        :param member: tarfile.TarInfo object
+        :param local_dir: Real path of the extraction directory
+        :return: False if the entry is to be skipped (devices, fifos)
+        :raise tarfile.ExtractError: If the entry or its link target is
+                                     outside local_dir
+        """
+        def is_inside(path):
+            path = os.path.realpath(path)
+            return path == local_dir or path.startswith(
+                os.path.join(local_dir, ""))
+
+        if member.ischr() or member.isblk() or member.isfifo():
+            return False
+        path = os.path.join(local_dir, member.name)
+        if os.path.isabs(member.name) or not is_inside(path):
+            raise tarfile.ExtractError("{} is outside of {}"
+                                       .format(member.name, local_dir))
+        if member.issym():
+            target = os.path.join(os.path.dirname(path), member.linkname)
+        elif member.islnk():
+            target = os.path.join(local_dir, member.linkname)
+        else:
+            return True
+        if os.path.isabs(member.linkname) or not is_inside(target):
+            raise tarfile.ExtractError("{} links to {}, outside of {}"
+                                       .format(member.name, member.linkname,
+                                               local_dir))
+        return True
+
+    def __open_channel(self):
+        """
+        Open a session channel, reconnecting first if the transport is
+        inactive. The caller has to hold a session slot
+        """
+        if not self.shell.remote:
+            raise IOError("{} is not a remote connection"
+                          .format(self.shell.ip))
+        self.shell.reconnect_if_inactive()
+        tp = self.shell._ssh_client.get_transport()
+        if tp is None or not tp.is_active():
+            raise IOError("No SSH connection to {}".format(self.shell.ip))
+        channel = tp.open_session()
+        channel.settimeout(self.timeout)
+        return channel
+
+    def put_tree(self, local_dir, remote_dir):
+        """
+        Upload the content of local_dir into remote_dir, which gets created
+        if it doesn't exist
+        :return: Number of entries sent
+        """
+        command = "mkdir -p {0} && tar -{1}pof - -C {0}".format(
+            shlex.quote(remote_dir), self.get_tar_options("x"))
+        start_time = time.time()
+        num_entries = 0
+        with self.shell._session_slots:
+            try:
+                channel = self.__open_channel()
+            except SSHException as e:
+                raise IOError("Unable to open a channel to {}: {}"
+                              .format(self.shell.ip, e))
+            try:
+                channel.exec_command(command)
+                writer = ChannelWriter(channel)
+                try:
+                    with tarfile.open(fileobj=writer,
+                                      mode="w|gz" if self.compress else "w|",
+                                      bufsize=self.buffer_size) as tar:
+                        for name in sorted(os.listdir(local_dir)):
+                            tar.add(os.path.join(local_dir, name),
+                                    arcname=name)
+                        num_entries = len(tar.getmembers())
+                except socket.error as e:
+                    # Remote tar exited early or stopped reading, its error
+                    # is reported below
+                    log.debug("{} - Tar stream interrupted: {}"
+                              .format(self.shell.ip, e))
+                finally:
+                    # EOF for the remote tar
+                    channel.shutdown_write()
+                _, error, exit_status = drain_channel(channel, self.timeout)
+                error = writer.error + error
+            except SSHException as e:
+                raise IOError("Tar stream to {} failed: {}"
+                              .format(self.shell.ip, e))
+            finally:
+                channel.close()
+        if exit_status != 0:
+            raise IOError("tar exited with {} on {}: {}"
+                          .format(exit_status, self.shell.ip,
+                                  " ".join(decode_lines(error))))
+        log.info("{} - Copied {} entries of {} to {} in {:.1f} secs"
+                 .format(self.shell.ip, num_entries, local_dir, remote_dir,
+                         time.time() - start_time))
+        return num_entries
+
+    def fetch_tree(self, remote_dir, local_dir, include=None):
+        """
+        Download remote_dir, or only its entries matching the include
+        patterns, into local_dir. The remote 'tar c' output is extracted
+        while it arrives. Safe to run for many nodes concurrently, every
+        call uses its own channel.
+        :param remote_dir: Remote directory
+        :param local_dir: Local directory, created if it doesn't exist
+        :param include: List of shell glob patterns relative to remote_dir,
+                        like ["*.zip", "logs"]. None for everything
+        :return: List of the names of the extracted entries
+        """
+        patterns = " ".join([self.get_shell_glob(pattern)
+                             for pattern in include or ["."]])
+        command = "sh -c {}".format(shlex.quote(FETCH_TREE_SCRIPT.format(
+            remote_dir=shlex.quote(remote_dir), patterns=patterns,
+            options=self.get_tar_options("c"))))
+        # Drops ownership and unsafe mode bits where supported. Entries
+        # pointing outside local_dir are rejected by check_member() anyway
+        extract_kwargs = dict()
+        if hasattr(tarfile, "data_filter"):
+            extract_kwargs["filter"] = "data"
+        os.makedirs(local_dir, exist_ok=True)
+        real_dir = os.path.realpath(local_dir)
+        start_time = time.time()
+        names = list()
+        read_error = None
+        with self.shell._session_slots:
+            try:
+                channel = self.__open_channel()
+            except SSHException as e:
+                raise IOError("Unable to open a channel to {}: {}"
+                              .format(self.shell.ip, e))
+            try:
+                channel.exec_command(command)
+                channel.shutdown_write()
+                reader = ChannelReader(channel)
+                try:
+                    with tarfile.open(fileobj=reader,
+                                      mode="r|gz" if self.compress else "r|",
+                                      bufsize=self.buffer_size) as tar:
+                        for member in tar:
+                            if not self.check_member(member, real_dir):
+                                log.debug("{} - Skipping special file {}"
+                                          .format(self.shell.ip,
+                                                  member.name))
+                                continue
+                            tar.extract(member, local_dir, **extract_kwargs)
+                            names.append(member.name)
+                except tarfile.ReadError as e:
+                    read_error = e
+                _, error, exit_status = drain_channel(channel, self.timeout)
+            except tarfile.TarError as e:
+                raise IOError("Unable to extract {} from {}: {}"
+                              .format(remote_dir, self.shell.ip, e))
+            except SSHException as e:
+                raise IOError("Tar stream from {} failed: {}"
+                              .format(self.shell.ip, e))
+            finally:
+                channel.close()
+        # GNU tar exits with 1 if files changed while being read, which is
+        # expected for logs still being written
+        if exit_status not in (0, 1):
+            raise IOError("tar exited with {} on {}: {}"
+                          .format(exit_status, self.shell.ip,
+                                  " ".join(decode_lines(error))))
+        if read_error is not None and reader.bytes_read:
+            raise IOError("Unable to extract {} from {}: {}"
+                          .format(remote_dir, self.shell.ip, read_error))
+        log.info("{} - Fetched {} entries of {} to {} in {:.1f} secs"
+                 .format(self.shell.ip, len(names), remote_dir, local_dir,
+                         time.time() - start_time))
+        return names
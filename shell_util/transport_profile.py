@@ -0,0 +1,123 @@
+import logging
+
+import paramiko
+
+from shell_util.openssh_client import OpenSSHClient
+
+log = logging.getLogger("shell_util")
+
+
+class TransportProfile(object):
+    """
+    Algorithm preferences and flow control settings of an SSH transport.
+
+    Preferred ciphers / MACs are moved to the front of the client's
+    proposal (the server picks the first one of the client's list it
+    supports), the remaining algorithms stay as fallback. Names the client
+    implementation doesn't support are skipped. window_size and
+    max_packet_size are the values advertised for every channel opened on
+    the transport, which bounds the throughput of downloads on links with
+    a high RTT (window_size / RTT).
+
+    Use INTERACTIVE for connections running commands and BULK for
+    connections transferring large files:
+
+        shell = RemoteMachineShellConnection(
+            server, transport_profile=TransportProfile.BULK)
+    """
+    INTERACTIVE = None
+    BULK = None
+
+    def __init__(self, name, ciphers=None, macs=None, compress=False,
+                 window_size=None, max_packet_size=None):
+        """
+        :param name: Name of the profile, part of the connection pool key
+        :param ciphers: Preferred ciphers, most preferred first
+        :param macs: Preferred MACs, most preferred first
+        :param compress: Enable zlib compression
+        :param window_size: Channel window size in bytes.
+                            None for the client's default
+        :param max_packet_size: Max. channel packet size in bytes.
+                                None for the client's default
+        """
+        self.name = name
+        self.ciphers = list(ciphers or [])
+        self.macs = list(macs or [])
+        self.compress = compress
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+
+    def __repr__(self):
+        return "TransportProfile({})".format(
+            ", ".join(["{}={}".format(k, v)
+                       for k, v in sorted(self.__dict__.items())]))
+
+    def get_connect_kwargs(self, client_class=paramiko.SSHClient):
+        """
+        :param client_class: Class of the SSH client to connect with
+        :return: Keyword args for client_class.connect()
+        """
+        if issubclass(client_class, OpenSSHClient):
+            return {"transport_profile": self}
+        return {"compress": self.compress,
+                "transport_factory": self.create_transport}
+
+    def create_transport(self, sock, **kwargs):
+        """
+        paramiko.Transport factory applying this profile
+        """
+        if self.window_size is not None:
+            kwargs["default_window_size"] = self.window_size
+        if self.max_packet_size is not None:
+            kwargs["default_max_packet_size"] = self.max_packet_size
+        transport = paramiko.Transport(sock, **kwargs)
+        options = transport.get_security_options()
+        if self.ciphers:
+            options.ciphers = self.__get_preferred(self.ciphers,
+                                                   options.ciphers)
+        if self.macs:
+            options.digests = self.__get_preferred(self.macs,
+                                                   options.digests)
+        return transport
+
+    def __get_preferred(self, preferred, available):
+        unsupported = [name for name in preferred if name not in available]
+        if unsupported:
+            log.debug("Profile '{}': {} not supported by paramiko"
+                      .format(self.name, ", ".join(unsupported)))
+        return tuple([name for name in preferred if name in available]
+                     + [name for name in available if name not in preferred])
+
+    def get_ssh_options(self):
+        """
+        :return: List of '-o' option values for the OpenSSH 'ssh' binary.
+                 Window and packet sizes are not configurable there
+        """
+        options = list()
+        if self.ciphers:
+            options.append("Ciphers=^{}".format(",".join(self.ciphers)))
+        if self.macs:
+            options.append("MACs=^{}".format(",".join(self.macs)))
+        options.append("Compression={}".format(
+            "yes" if self.compress else "no"))
+        return options
+
+
+# Small packets, latency bound: cheap AEAD ciphers, no compression
+TransportProfile.INTERACTIVE = TransportProfile(
+    "interactive",
+    ciphers=["aes128-gcm@openssh.com", "aes128-ctr"],
+    macs=["hmac-sha2-256-etm@openssh.com", "hmac-sha2-256"],
+    compress=False)
+
+# Large (already compressed) files: fast ciphers, no compression and a
+# bigger channel window for high RTT links. Kept moderate, since paramiko
+# gets slower once a lot of unread data piles up in a channel's buffer
+TransportProfile.BULK = TransportProfile(
+    "bulk",
+    ciphers=["aes128-gcm@openssh.com", "chacha20-poly1305@openssh.com",
+             "aes128-ctr"],
+    macs=["hmac-sha2-256-etm@openssh.com", "hmac-sha2-256"],
+    compress=False,
+    window_size=4 * 1024 * 1024,
+    max_packet_size=32 * 1024)